@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import timeit
+
+from sparrowmail.scripts import dovecot
+
+
+def bench (name, func, number) :
+    """Run func number times and print how many runs per second were done"""
+
+    try :
+        seconds = timeit.timeit(func, number=number)
+    except OSError :
+        # The command used by func is not installed
+        print(name + ' : unavailable')
+    else :
+        print(name + ' : ' + str(int(number / seconds)) + ' ops/s')
+
+
+def bench_passwd (number) :
+    """Compare the in-process SSHA512 implementation with doveadm"""
+
+    pw = u'correct horse battery staple'
+    hashed_passwd = dovecot.hash_ssha512(pw)
+
+    bench('SSHA512 hash (python)', lambda : dovecot.hash_ssha512(pw), number)
+    bench('SSHA512 verify (python)', lambda : dovecot.verify_ssha512(pw, hashed_passwd), number)
+    bench('SSHA512 hash (doveadm)', lambda : dovecot.doveadm_hash_passwd(pw, 'SSHA512'), number)
+    bench('SSHA512 verify (doveadm)', lambda : dovecot.doveadm_verify_passwd(pw, hashed_passwd), number)
+
+
+if len(sys.argv) > 1 :
+    number = int(sys.argv[1])
+else :
+    number = 100
+
+bench_passwd(number)
@@ -11,5 +11,8 @@ setup(
         'sparrowmail',
         'email_validator',
         'flask',
+        'scandir; python_version < "3.5"',
+        # Threads of the gunicorn workers
+        'futures; python_version < "3"',
     ],
     )
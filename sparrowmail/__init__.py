@@ -1,4 +1,5 @@
 from .main import app
 from .main import connect_db
+from .main import db_manager
 from .main import log
 from .main import initdb_python
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""Journal of the changes of the mails and filters
+
+Every insert, update and delete of the mails table appends a row to the
+changes table through triggers, whatever code path made it. The changes of
+the sieve filters, which are not in the database, are recorded by the code
+writing them. Sequence numbers only grow : SQLite has a single writer, so a
+change is never committed after one with a greater number.
+
+Consumers keep the last sequence number they processed, in memory or in the
+change_cursors table, and ask for the changes since it. When the changes
+they need were pruned, they have to read the whole tables again.
+"""
+
+import time
+
+SCHEMA = [
+"""CREATE TABLE IF NOT EXISTS changes (
+    seq         integer primary key autoincrement,
+    changed_at  integer not null,
+    kind        text    not null,
+    op          text    not null,
+    address     text    not null,
+    end_date    integer
+)""",
+
+"""CREATE TABLE IF NOT EXISTS change_cursors (
+    name        text    primary key,
+    seq         integer not null
+)""",
+]
+
+# Record the changes of the mails, created again when the mails table is rebuilt
+TRIGGERS = [
+"""CREATE TRIGGER IF NOT EXISTS mails_changes_insert AFTER INSERT ON mails BEGIN
+    INSERT INTO changes (changed_at, kind, op, address, end_date)
+        VALUES (CAST(strftime('%s', 'now') AS integer), 'mail', 'insert', new.address, new.end_date);
+END""",
+
+"""CREATE TRIGGER IF NOT EXISTS mails_changes_delete AFTER DELETE ON mails BEGIN
+    INSERT INTO changes (changed_at, kind, op, address, end_date)
+        VALUES (CAST(strftime('%s', 'now') AS integer), 'mail', 'delete', old.address, NULL);
+END""",
+
+"""CREATE TRIGGER IF NOT EXISTS mails_changes_update AFTER UPDATE ON mails BEGIN
+    INSERT INTO changes (changed_at, kind, op, address, end_date)
+        SELECT CAST(strftime('%s', 'now') AS integer), 'mail', 'delete', old.address, NULL
+        WHERE old.address != new.address;
+    INSERT INTO changes (changed_at, kind, op, address, end_date)
+        VALUES (CAST(strftime('%s', 'now') AS integer), 'mail', 'update', new.address, new.end_date);
+END""",
+]
+
+
+def create_tables( db ) :
+    """Create the journal tables and the triggers filling them, without committing"""
+
+    for statement in SCHEMA + TRIGGERS :
+        db.execute( statement )
+
+
+def create_triggers( db ) :
+    """Create the triggers of existing journal tables, without committing"""
+
+    for trigger in TRIGGERS :
+        db.execute( trigger )
+
+
+def has_tables( db ) :
+    """Tell if the journal tables exist in the database"""
+
+    cur = db.execute( "SELECT 1 FROM sqlite_master WHERE name='changes'" )
+    return cur.fetchone() is not None
+
+
+def record( db, kind, op, address ) :
+    """Append a change made outside of the mails table, without committing.
+    Return its sequence number"""
+
+    cur = db.execute( 'INSERT INTO changes (changed_at, kind, op, address) VALUES (?, ?, ?, ?)',
+            [ int( time.time() ), kind, op, address ] )
+    return cur.lastrowid
+
+
+def latest( db ) :
+    """Return the sequence number of the last change, 0 if there is none"""
+
+    row = db.execute( "SELECT seq FROM sqlite_sequence WHERE name='changes'" ).fetchone()
+    return row[0] if row else 0
+
+
+def since( db, seq, limit=1000, kind=None ) :
+    """Return (rows, complete) : the changes after seq in order, at most limit of
+    them, and False in complete if some changes after seq were pruned
+    or the journal was created again since seq"""
+
+    query = 'SELECT seq, changed_at, kind, op, address, end_date FROM changes WHERE seq > ?'
+    args = [ seq ]
+    if kind is not None :
+        query += ' AND kind=?'
+        args.append( kind )
+    rows = db.execute( query+' ORDER BY seq LIMIT ?', args + [ limit ] ).fetchall()
+
+    # Checked after reading them, a prune in between only makes it look incomplete
+    last = latest( db )
+    row = db.execute( 'SELECT MIN(seq) FROM changes' ).fetchone()
+    oldest = row[0] if row[0] is not None else last + 1
+    return ( rows, oldest <= seq + 1 and seq <= last )
+
+
+def get_cursor( db, name ) :
+    """Return the sequence number a consumer processed, None if it never did"""
+
+    row = db.execute( 'SELECT seq FROM change_cursors WHERE name=?', [ name ] ).fetchone()
+    return row[0] if row else None
+
+
+def set_cursor( db, name, seq ) :
+    """Save the sequence number a consumer processed, without committing"""
+
+    db.execute( 'INSERT OR REPLACE INTO change_cursors (name, seq) VALUES (?, ?)', [ name, seq ] )
+
+
+def prune( db, keep ) :
+    """Delete all but the last keep changes, without committing.
+    Return the number of deleted changes"""
+
+    cur = db.execute( 'DELETE FROM changes WHERE seq <= ?', [ latest( db ) - keep ] )
+    return cur.rowcount
@@ -26,10 +26,29 @@ SESSION_REFRESH_EACH_REQUEST = True
 #   Server hostname and port
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = '10334'
+#   'development' for the flask debug server
+#   'production' for gunicorn workers (debug is then always off)
+#   Each worker process has its own sync worker, reload manager, filter index
+#   and expiry scheduler : reloads are only merged within a process, and the
+#   workers share the filter index through FILTER_INDEX_PATH only
+#   Set EXPIRY_IN_BACKGROUND = False and run `flask expired` to expire from one process
+SERVER_MODE = 'development'
+#   Number of worker processes in production, 0 for 2 * cpus + 1
+SERVER_WORKERS = 0
+#   Number of requests each worker handles at the same time
+SERVER_THREADS = 4
+#   Seconds a connection is kept open waiting for the next request
+SERVER_KEEPALIVE = 5
+#   Seconds given to the workers to finish their requests on reload or stop
+SERVER_GRACEFUL_TIMEOUT = 30
+#   Seconds before a silent worker is killed and started again
+SERVER_TIMEOUT = 60
 #   Website root url
 #   None if sub-domain is only used for SparrowMail
 #   http{s|}://<SERVER_NAME>/<APPLICATION_ROOT> if not
 APPLICATION_ROOT = None
+#   Number of mailboxes listed on each page of /mails/
+MAILS_PAGE_SIZE = 50
 
 
 
@@ -38,6 +57,14 @@ APPLICATION_ROOT = None
 ###################
 #   Where the database is store
 DATABASE = 'sparrowmail/db/sparrowmail.db'
+#   Milliseconds a connection waits for another one to finish writing
+DATABASE_BUSY_TIMEOUT = 5000
+#   Pages kept in memory by each connection, negative values are in KiB
+DATABASE_CACHE_SIZE = -8000
+#   Bytes of the database read through memory mapping, 0 to disable
+DATABASE_MMAP_SIZE = 67108864
+#   Number of prepared statements kept by each connection
+DATABASE_STATEMENT_CACHE_SIZE = 100
 
 
 
@@ -49,14 +76,43 @@ ALIASES_FILE_PATH = '/tmp/aliases'
 #   mailboxes addresses
 #   in postfix conf : virtual_mailbox_maps
 MAILBOXES_FILE_PATH = '/tmp/mailboxes'
+#   Write the two files above after each change
+#   Set to False when postfix queries the lookup server instead
+PUBLISH_POSTFIX_MAPS = True
+#   Type of the maps built from the two files, as in postfix conf : <type>:<file>
+POSTFIX_MAP_TYPE = 'hash'
+
+
+
+## Lookup server for postfix virtual maps ##
+############################################
+#   Started with `flask lookupd`, answers with the database content
+#   in postfix conf :
+#       virtual_alias_maps = socketmap:inet:<host>:<port>:aliases
+#       virtual_mailbox_maps = socketmap:inet:<host>:<port>:mailboxes
+LOOKUP_HOST = '127.0.0.1'
+LOOKUP_PORT = 10335
+#   Number of lookup results kept in memory
+LOOKUP_CACHE_SIZE = 10000
 
 
 
 ## Files for dovecot management ##
 ##################################
-#   mailboxes passwords
+#   mailboxes passwords, generated from the database
 #   in dovecot conf : passdb { args = username_format=%u scheme=ssha512 <file> }
 PASSWD_FILE_PATH = '/tmp/passwd.db'
+#   Write the file above after each change
+#   Set to False when dovecot queries the dict server instead
+PUBLISH_PASSWD_FILE = True
+
+
+
+## Dict server for dovecot passwords ##
+#######################################
+#   Started with `flask dictd`, answers with the database content
+#   in dovecot conf : dict { sparrowmail = proxy:<DICT_SOCKET_PATH>:passdb }
+DICT_SOCKET_PATH = '/tmp/sparrowmail-dict'
 
 
 
@@ -71,4 +127,92 @@ EXCLUDE_DIRS = ['sieve-after', 'sieve-after']
 #   The name of the sieve files
 #   in dovecot conf : plugin { sieve = <file> }
 SIEVE_FILENAME = '.dovecot.sieve'
-
+#   Where the index of the virtual mailboxes tree is saved between restarts
+#   and shared by the workers. None to keep it in the memory of each worker
+FILTER_INDEX_PATH = 'sparrowmail/db/filters.json'
+#   Number of domains listed at the same time when refreshing this index
+FILTER_INDEX_WORKERS = 4
+#   Maximum number of sievec checking filters at the same time
+SIEVE_COMPILE_WORKERS = 2
+#   Number of filters whose check result is remembered
+SIEVE_COMPILE_CACHE_SIZE = 256
+
+
+
+
+## Mail server files synchronisation ##
+#######################################
+#   Publish postfix maps and dovecot passwords in a background thread
+#   If False, each request waits for the files to be published
+SYNC_IN_BACKGROUND = True
+#   Seconds without any new change before publishing a burst of changes
+SYNC_DEBOUNCE = 2
+#   Maximum seconds a change can wait before being published
+SYNC_MAX_LATENCY = 10
+
+
+
+## Temporary mails expiry ##
+############################
+#   Delete the mails from a thread of each web worker as soon as they expire
+#   If False, run `flask expired` or `del_tmp_mails.py` from a cron instead
+EXPIRY_IN_BACKGROUND = True
+#   Seconds between two readings of the end dates set by the other processes
+#   Only the changes since the previous reading are read
+EXPIRY_REFRESH = 60
+
+
+
+## Cross-process locks ##
+###########################
+#   Directory of the lock files guarding the passwd, map and sieve files
+#   None to create them next to the guarded files
+LOCK_DIR = None
+#   Seconds a writer waits for another one before giving up, None to wait forever
+LOCK_TIMEOUT = 30
+
+
+
+## Changes journal ##
+#######################
+#   Number of changes of the mails and filters kept in the changes table
+CHANGES_HISTORY = 100000
+#   Consumers with more changes than this to process read the whole tables instead
+CHANGES_DELTA_LIMIT = 1000
+
+
+
+## Replication to other mail nodes ##
+######################################
+#   On the node running SparrowMail :
+#   Directory of the journal of the published files, None to disable replication
+REPLICATION_DIR = None
+#   Number of versions kept, older replicas get all the files again
+REPLICATION_HISTORY = 100
+#   Secret the agents send to pull the journal from /replication/
+REPLICATION_TOKEN = None
+#   On the other nodes, running `flask replica` :
+#   URL of the /replication/ pages or path of a journal directory
+REPLICATION_SOURCE = 'http://127.0.0.1:10334/replication'
+#   Name reported by this node, None for its hostname
+REPLICATION_NODE = None
+#   Directory of each kind of replicated files on this node
+REPLICATION_TARGETS = {
+    'postfix' : '/etc/postfix/sparrowmail',
+    'dovecot' : '/etc/dovecot/sparrowmail',
+    'vmail' : '/var/vmail',
+}
+#   Where this node saves the version and the files it applied
+REPLICATION_STATE = 'sparrowmail/db/replica.json'
+#   Seconds between two pulls
+REPLICATION_INTERVAL = 10
+
+
+
+## Services reloads ##
+######################
+#   Seconds to wait before a reload so the following requests are merged in it
+RELOAD_WINDOW = 0
+#   Minimum seconds between two reloads of the same service
+#   Requests coming sooner are merged in one delayed reload
+RELOAD_MIN_INTERVAL = 10
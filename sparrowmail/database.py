@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+
+
+def connect( database, busy_timeout=5000, cache_size=-8000, mmap_size=0,
+        statement_cache_size=100, check_same_thread=True ) :
+    """Open a connection to the database and tune it.
+    busy_timeout is in milliseconds, cache_size follows PRAGMA cache_size
+    (negative values are KiB) and mmap_size is in bytes"""
+
+    # The python module prepares statements once and keeps them in this cache
+    db = sqlite3.connect( database, timeout=busy_timeout / 1000.0,
+            cached_statements=statement_cache_size,
+            check_same_thread=check_same_thread )
+    db.row_factory = sqlite3.Row
+
+    # Readers don't block the writer nor the other way around
+    db.execute( 'PRAGMA journal_mode=WAL' )
+    # Durable enough in WAL mode, only the last commits can be lost on power loss
+    db.execute( 'PRAGMA synchronous=NORMAL' )
+    db.execute( 'PRAGMA busy_timeout=%d' % int( busy_timeout ) )
+    db.execute( 'PRAGMA cache_size=%d' % int( cache_size ) )
+    db.execute( 'PRAGMA mmap_size=%d' % int( mmap_size ) )
+    # Aliases are deleted with their mailbox
+    db.execute( 'PRAGMA foreign_keys=ON' )
+    return db
+
+
+class ConnectionManager :
+    """Keep one long-lived connection to the database per thread.
+    Connections of finished threads are closed when a new one is opened
+    and all of them are forgotten after a fork"""
+
+    def __init__( self, database, **options ) :
+        self.database = database
+        self.options = options
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pid = os.getpid()
+        # Thread ident -> connection, to close the ones of finished threads
+        self.connections = {}
+        self.opened = 0
+        self.closed = 0
+        self.reused = 0
+
+    def configure( self, database, **options ) :
+        """Change the database or its settings. Opened connections are closed
+        the next time their thread asks for one"""
+
+        with self.lock :
+            self.database = database
+            self.options = options
+            self.local = threading.local()
+
+    def _check_fork( self ) :
+        """Forget the connections inherited from the parent process.
+        Must be called with the lock held"""
+
+        if self.pid != os.getpid() :
+            # Closing them here would touch the parent's locks
+            self.pid = os.getpid()
+            self.local = threading.local()
+            self.connections = {}
+
+    def _close_finished( self ) :
+        """Close the connections of the threads that ended. Must be called with the lock held"""
+
+        alive = set( thread.ident for thread in threading.enumerate() )
+        for ident in list( self.connections ) :
+            if ident not in alive :
+                self.connections.pop( ident ).close()
+                self.closed += 1
+
+    def get( self ) :
+        """Return the connection of the current thread, opening it if needed"""
+
+        with self.lock :
+            self._check_fork()
+            local = self.local
+            db = getattr( local, 'db', None )
+            if db is not None :
+                self.reused += 1
+                return db
+
+            self._close_finished()
+            ident = threading.current_thread().ident
+            old = self.connections.pop( ident, None )
+            if old is not None :
+                # Left over by configure()
+                old.close()
+                self.closed += 1
+
+            # Closed from another thread when this one ends
+            db = connect( self.database, check_same_thread=False, **self.options )
+            local.db = db
+            self.connections[ident] = db
+            self.opened += 1
+            return db
+
+    def release( self ) :
+        """End the current thread's use of its connection, keeping it open.
+        Whatever was not committed is rolled back"""
+
+        db = getattr( self.local, 'db', None )
+        if db is not None :
+            db.rollback()
+
+    def close( self ) :
+        """Close the connection of the current thread"""
+
+        with self.lock :
+            db = getattr( self.local, 'db', None )
+            if db is None :
+                return
+            del self.local.db
+            self.connections.pop( threading.current_thread().ident, None )
+            db.close()
+            self.closed += 1
+
+    def stats( self ) :
+        """Return a dict describing the pool"""
+
+        with self.lock :
+            self._check_fork()
+            return {
+                'connections' : len( self.connections ),
+                'opened' : self.opened,
+                'closed' : self.closed,
+                'reused' : self.reused,
+                'statement_cache_size' : self.options.get( 'statement_cache_size', 100 ),
+            }
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""End dates of the mails
+
+They are stored as integer UTC unix timestamps so the expiry is a range
+scan of the end_date index. Dates given without a timezone are UTC.
+"""
+
+import calendar
+from datetime import datetime
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_timestamp( date ) :
+    """Return the timestamp of a UTC datetime, None for None"""
+
+    if date is None :
+        return None
+    return calendar.timegm( date.utctimetuple() )
+
+
+def from_timestamp( timestamp ) :
+    """Return the UTC datetime of a timestamp, None for None"""
+
+    if timestamp is None :
+        return None
+    return datetime.utcfromtimestamp( timestamp )
+
+
+def parse_date( value, date_format=DATE_FORMAT ) :
+    """Return the timestamp of a date given as text, None for None or ''.
+    Raise ValueError if it doesn't match date_format"""
+
+    if not value :
+        return None
+    return to_timestamp( datetime.strptime( value, date_format ) )
+
+
+def format_date( timestamp, date_format=DATE_FORMAT ) :
+    """Return a timestamp as text, None for None"""
+
+    if timestamp is None :
+        return None
+    return from_timestamp( timestamp ).strftime( date_format )
@@ -1,5 +1,4 @@
-DROP TABLE IF EXISTS users;
-CREATE TABLE users (
+CREATE TABLE IF NOT EXISTS users (
     id integer primary key autoincrement,
     username text not null unique,
     password text not null,
@@ -7,10 +6,10 @@ CREATE TABLE users (
 );
 
 INSERT INTO users (username, password, salt)
-VALUES ("user", "b2d1349ea3f52597f37566ed4095e10729c8329c612b64563849dcf29ee9de6e", "123456789");
+SELECT "user", "b2d1349ea3f52597f37566ed4095e10729c8329c612b64563849dcf29ee9de6e", "123456789"
+WHERE NOT EXISTS (SELECT 1 FROM users);
 
-DROP TABLE IF EXISTS mails;
-CREATE TABLE mails (
+CREATE TABLE IF NOT EXISTS mails (
     id           integer primary key autoincrement,
     address      text    not null unique,
     target_id    integer,
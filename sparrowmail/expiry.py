@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import os
+import heapq
+import threading
+import time
+
+# Seconds to wait before loading the end dates again after a failure
+RETRY_DELAY = 60
+
+class ExpiryScheduler :
+    """Background thread deleting the mails as soon as their end date is passed.
+    The upcoming end dates are kept in a min-heap and the thread sleeps until
+    the first one, so nothing is scanned while nothing expires.
+    load is called with the cursor it returned the previous time, None the
+    first time, and returns the end dates set in the database since then (all
+    of them for None) and a new cursor.
+    expire is called without argument when one of them is passed and returns
+    the number of deleted mails, None on failure to be called again later.
+    If refresh is given, load is called again every refresh seconds to see
+    the end dates set by other processes"""
+
+    def __init__( self, load, expire, refresh=None ) :
+        self.load = load
+        self.expire = expire
+        self.refresh = refresh
+        self.cond = threading.Condition()
+        self.thread = None
+        self.pid = None
+        self.heap = []
+        self.loaded = None
+        self.cursor = None
+        # Time and number of addresses of the last expiry
+        self.last_expire = None
+        self.last_count = None
+
+    def start( self ) :
+        """Start the thread if it isn't running in this process"""
+
+        with self.cond :
+            # Threads don't survive a fork so check the pid too
+            if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid() :
+                return
+            self.pid = os.getpid()
+            self.heap = []
+            self.loaded = None
+            self.cursor = None
+            self.thread = threading.Thread( target=self._run, name='sparrowmail-expiry' )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def schedule( self, end_date ) :
+        """Notify the scheduler of a new or changed end date, a timestamp"""
+
+        if end_date is None :
+            return
+        with self.cond :
+            # Only the first deadline matters to the sleeping thread
+            heapq.heappush( self.heap, end_date )
+            if self.heap[0] == end_date :
+                self.cond.notify_all()
+
+    def _reload( self ) :
+        """Fill the heap with the end dates of the database. Must be called with the lock held"""
+
+        end_dates, self.cursor = self.load( self.cursor )
+        self.heap = list( set( end_dates ) | set( self.heap ) )
+        heapq.heapify( self.heap )
+        self.loaded = time.time()
+
+    def _run( self ) :
+        while True :
+            with self.cond :
+                if self.loaded is None or ( self.refresh is not None
+                        and time.time() >= self.loaded + self.refresh ) :
+                    try :
+                        self._reload()
+                    except Exception :
+                        # The next end dates are unknown, try again later
+                        self.cond.wait( RETRY_DELAY )
+                        continue
+
+                # Mails expire once their end date is lower than the current second
+                now = time.time()
+                if not self.heap or self.heap[0] >= int( now ) :
+                    timeout = None
+                    if self.heap :
+                        timeout = self.heap[0] + 1 - now
+                    if self.refresh is not None :
+                        timeout = self.refresh if timeout is None else min( timeout, self.refresh )
+                    self.cond.wait( timeout )
+                    continue
+
+            # Expire outside of the lock so edits are never blocked
+            count = self.expire()
+
+            with self.cond :
+                self.last_expire = time.time()
+                self.last_count = count
+                if count is None :
+                    # Deadlines kept, tried again later
+                    self.cond.wait( RETRY_DELAY )
+                    continue
+
+                # Everything passed was deleted at once
+                while self.heap and self.heap[0] < int( now ) :
+                    heapq.heappop( self.heap )
+
+    def status( self ) :
+        """Return a dict describing the state of the scheduler"""
+
+        with self.cond :
+            return {
+                'running' : self.thread is not None and self.thread.is_alive() and self.pid == os.getpid(),
+                'next_end_date' : self.heap[0] if self.heap else None,
+                'pending' : len( self.heap ),
+                'last_expire' : self.last_expire,
+                'last_count' : self.last_count,
+            }
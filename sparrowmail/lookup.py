@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+"""Servers answering the mail server lookups from the database
+
+Postfix socketmap server, in postfix conf :
+    virtual_alias_maps = socketmap:inet:<LOOKUP_HOST>:<LOOKUP_PORT>:aliases
+    virtual_mailbox_maps = socketmap:inet:<LOOKUP_HOST>:<LOOKUP_PORT>:mailboxes
+
+Dovecot dict-proxy server for the passwords, in dovecot conf :
+    dict { sparrowmail = proxy:<DICT_SOCKET_PATH>:passdb }
+    passdb { driver = dict  args = /etc/dovecot/dict-passdb.conf }
+and in dict-passdb.conf :
+    uri = proxy:<DICT_SOCKET_PATH>:passdb
+    default_pass_scheme = SSHA512
+    key passdb {
+        key = passdb/%u
+        format = json
+    }
+    passdb_objects = passdb
+"""
+
+import os
+import json
+import socket
+import sqlite3
+import threading
+import SocketServer
+from collections import OrderedDict
+
+from sparrowmail import changes
+from sparrowmail import database
+
+# One query per map, always the same strings so sqlite3 keeps them prepared
+QUERIES = {
+    'aliases' : 'SELECT t.address FROM mails AS m JOIN mails AS t ON t.id=IFNULL(m.target_id, m.id) WHERE m.address=?',
+    'mailboxes' : 'SELECT address FROM mails WHERE address=? AND target_id ISNULL',
+    'passdb' : 'SELECT password FROM mails WHERE address=? AND target_id ISNULL AND password NOTNULL',
+}
+
+# Prefix of the dict keys dovecot looks the passwords up with
+PASSDB_KEY = 'shared/passdb/'
+
+# Changes read at once to invalidate the cached lookups, the whole cache is dropped beyond
+INVALIDATION_LIMIT = 1000
+
+# Longest request accepted, postfix never sends more than an address
+MAX_REQUEST_LENGTH = 10000
+
+
+class LRUCache :
+    """A thread safe LRU cache whose entries are only valid for one generation"""
+
+    def __init__( self, size ) :
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate( self, keys=None ) :
+        """Make the entries of the keys stale, all of them if keys is None"""
+
+        with self.lock :
+            # Values being computed from before now can't be cached anymore
+            self.generation += 1
+            if keys is None :
+                return
+            keys = set( keys )
+            for key, entry in self.entries.items() :
+                if key in keys :
+                    del self.entries[key]
+                elif entry[0] == self.generation - 1 :
+                    # Still valid, moved to the new generation in place
+                    self.entries[key] = ( self.generation, entry[1] )
+
+    def get( self, key ) :
+        """Return (True, value) if the key is cached for this generation, (False, None) if not"""
+
+        with self.lock :
+            entry = self.entries.pop( key, None )
+            if entry is None or entry[0] != self.generation :
+                self.misses += 1
+                return (False, None)
+            # Put it back as the most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return (True, entry[1])
+
+    def set( self, key, value, generation ) :
+        """Cache a value computed during the given generation"""
+
+        with self.lock :
+            if generation != self.generation :
+                return
+            self.entries.pop( key, None )
+            self.entries[key] = ( generation, value )
+            while len( self.entries ) > self.size :
+                self.entries.popitem( last=False )
+
+
+class MailsLookup :
+    """Answer the maps lookups against the mails table.
+    Results are cached until the journal shows a change of their address.
+    options are the settings of the connections, as database.connect takes them"""
+
+    def __init__( self, path, cache_size, **options ) :
+        self.path = path
+        self.options = options
+        self.cache = LRUCache( cache_size )
+        self.local = threading.local()
+        # Last change of the journal taken into account by the cache
+        self.seq = None
+        self.seq_lock = threading.Lock()
+
+    def _connection( self ) :
+        """Return the connection of the current thread"""
+
+        db = getattr( self.local, 'db', None )
+        if db is None :
+            # Tuned like the connections of the web workers
+            db = database.connect( self.path, **self.options )
+            self.local.db = db
+            self.local.data_version = None
+        return db
+
+    def _check_generation( self, db ) :
+        """Invalidate the cache if the database changed since the last lookup"""
+
+        # data_version changes each time another connection commits
+        data_version = db.execute( 'PRAGMA data_version' ).fetchone()[0]
+        if self.local.data_version is None or data_version != self.local.data_version :
+            self._invalidate_changes( db )
+        self.local.data_version = data_version
+
+    def _invalidate_changes( self, db ) :
+        """Drop the cached lookups of the addresses changed since the last check"""
+
+        with self.seq_lock :
+            try :
+                seq = changes.latest( db )
+                if self.seq is None :
+                    rows, complete = [], False
+                else :
+                    rows, complete = changes.since( db, self.seq, INVALIDATION_LIMIT, kind='mail' )
+            except sqlite3.OperationalError :
+                # Database without the changes journal
+                self.cache.invalidate()
+                return
+
+            if not complete or len( rows ) >= INVALIDATION_LIMIT :
+                self.cache.invalidate()
+                self.seq = seq
+            elif rows :
+                self.cache.invalidate( [ ( name, row['address'] ) for row in rows for name in QUERIES ] )
+                self.seq = rows[-1]['seq']
+
+    def lookup( self, name, key ) :
+        """Return the value associated with key in the map name, None if there is none
+        Raise KeyError if the map doesn't exist"""
+
+        query = QUERIES[name]
+        db = self._connection()
+        self._check_generation( db )
+
+        generation = self.cache.generation
+        found, value = self.cache.get( ( name, key ) )
+        if found :
+            return value
+
+        row = db.execute( query, [key] ).fetchone()
+        value = row[0] if row else None
+        self.cache.set( ( name, key ), value, generation )
+        return value
+
+
+def read_netstring( f ) :
+    """Read a netstring from a file object. Return None at the end of the stream"""
+
+    length = ''
+    while True :
+        c = f.read( 1 )
+        if not c :
+            return None
+        if c == ':' :
+            break
+        if not c.isdigit() or len( length ) > len( str( MAX_REQUEST_LENGTH ) ) :
+            raise ValueError( 'Malformed netstring length' )
+        length += c
+
+    length = int( length )
+    if length > MAX_REQUEST_LENGTH :
+        raise ValueError( 'Netstring too long' )
+    data = f.read( length )
+    if len( data ) != length or f.read( 1 ) != ',' :
+        raise ValueError( 'Malformed netstring' )
+    return data
+
+
+def format_netstring( data ) :
+    """Encode data as a netstring"""
+
+    return str( len( data ) ) + ':' + data + ','
+
+
+class SocketmapHandler( SocketServer.StreamRequestHandler ) :
+    """Answer the socketmap requests of one postfix connection"""
+
+    def handle( self ) :
+        while True :
+            try :
+                request = read_netstring( self.rfile )
+            except ValueError :
+                # The stream can't be trusted anymore
+                return
+            if request is None :
+                return
+
+            self.wfile.write( format_netstring( self.answer( request ) ) )
+            self.wfile.flush()
+
+    def answer( self, request ) :
+        """Return the response to one 'name key' request"""
+
+        try :
+            name, key = request.split( ' ', 1 )
+            key = key.decode( 'utf-8' )
+        except ValueError :
+            return 'PERM malformed request'
+
+        try :
+            value = self.server.lookup.lookup( name, key )
+        except KeyError :
+            return 'PERM unknown map '+name
+        except sqlite3.Error as e :
+            return 'TEMP '+str( e )
+
+        if value is None :
+            return 'NOTFOUND '
+        return 'OK '+value.encode( 'utf-8' )
+
+
+class SocketmapServer( SocketServer.ThreadingTCPServer ) :
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__( self, address, lookup ) :
+        SocketServer.ThreadingTCPServer.__init__( self, address, SocketmapHandler )
+        self.lookup = lookup
+
+
+class SocketmapClient :
+    """Minimal socketmap client behaving like postfix, for testing the server"""
+
+    def __init__( self, host, port, timeout=10 ) :
+        self.sock = socket.create_connection( ( host, port ), timeout )
+        self.rfile = self.sock.makefile( 'rb' )
+
+    def lookup( self, name, key ) :
+        """Return the (status, data) response for key in the map name"""
+
+        self.sock.sendall( format_netstring( name+' '+key.encode( 'utf-8' ) ) )
+        response = read_netstring( self.rfile )
+        if response is None :
+            raise IOError( 'Connection closed by the server' )
+        status, data = response.split( ' ', 1 )
+        return ( status, data.decode( 'utf-8' ) )
+
+    def close( self ) :
+        self.rfile.close()
+        self.sock.close()
+
+
+def dict_unescape( data ) :
+    """Decode a value escaped by the dovecot dict protocol"""
+
+    chars = { '1' : '\001', 't' : '\t', 'r' : '\r', 'n' : '\n' }
+    out = []
+    i = 0
+    while i < len( data ) :
+        if data[i] == '\001' and i + 1 < len( data ) :
+            out.append( chars.get( data[i+1], data[i+1] ) )
+            i += 2
+        else :
+            out.append( data[i] )
+            i += 1
+    return ''.join( out )
+
+
+def dict_escape( data ) :
+    """Encode a value for the dovecot dict protocol"""
+
+    return ( data.replace( '\001', '\0011' ).replace( '\t', '\001t' )
+            .replace( '\r', '\001r' ).replace( '\n', '\001n' ) )
+
+
+class DictHandler( SocketServer.StreamRequestHandler ) :
+    """Answer the dict requests of one dovecot connection.
+    Only the lookups are supported, the passwords are changed through SparrowMail"""
+
+    def handle( self ) :
+        while True :
+            line = self.rfile.readline( MAX_REQUEST_LENGTH )
+            if not line :
+                return
+            if not line.endswith( '\n' ) :
+                # The stream can't be trusted anymore
+                return
+            line = line.rstrip( '\n' )
+
+            # The handshake and the other commands need no answer
+            if not line.startswith( 'L' ) :
+                continue
+
+            self.wfile.write( self.answer( line[1:].split( '\t' )[0] ) + '\n' )
+            self.wfile.flush()
+
+    def answer( self, key ) :
+        """Return the response to the lookup of one key"""
+
+        key = dict_unescape( key ).decode( 'utf-8' )
+        if not key.startswith( PASSDB_KEY ) :
+            return 'N'
+
+        try :
+            value = self.server.lookup.lookup( 'passdb', key[len( PASSDB_KEY ):] )
+        except sqlite3.Error as e :
+            return 'F'+dict_escape( str( e ) )
+
+        if value is None :
+            return 'N'
+        return 'O'+dict_escape( json.dumps( { 'password' : value } ) )
+
+
+class DictServer( SocketServer.ThreadingUnixStreamServer ) :
+    daemon_threads = True
+
+    def __init__( self, path, lookup ) :
+        # A socket left by a previous run would make the bind fail
+        if os.path.exists( path ) :
+            os.remove( path )
+        SocketServer.ThreadingUnixStreamServer.__init__( self, path, DictHandler )
+        self.lookup = lookup
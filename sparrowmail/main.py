@@ -3,6 +3,8 @@
 # Import PyPI packages
 import os
 import sys
+import hmac
+import socket
 import sqlite3
 import time
 from random import randint
@@ -11,16 +13,30 @@ from datetime import datetime
 from exceptions import ValueError
 
 # Import other packages
+import click
 from email_validator import validate_email, EmailNotValidError
 
 # Import flask packages
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-             render_template, flash
+             render_template, flash, jsonify, Response
 
 # Import custom packages
 from sparrowmail.scripts import postfix
 from sparrowmail.scripts import dovecot
 from sparrowmail.scripts import sieve
+from sparrowmail.scripts import services
+from sparrowmail.scripts import lock
+from sparrowmail.scripts import publish
+from sparrowmail.sync import SyncWorker
+from sparrowmail.expiry import ExpiryScheduler
+from sparrowmail import database
+from sparrowmail import dates
+from sparrowmail import migrations
+from sparrowmail import search
+from sparrowmail import transfer
+from sparrowmail import replication
+from sparrowmail import changes
+from sparrowmail.lookup import MailsLookup, SocketmapServer, SocketmapClient, DictServer
 from sparrowmail.error import Error, MissingArg, WrongArg, DBManip, SieveManip, SieveSyntax, DovecotManip, PostfixManip, Hacker, Unknown, ConfPasswd
 
 app = Flask(__name__) # create the application instance :)
@@ -29,45 +45,160 @@ app.config.from_object('sparrowmail.config') # load config from the config.py fi
 # Override config from an environment variable
 app.config.from_envvar('SPARROWMAIL_SETTINGS', silent=True)
 
+services.manager.configure(app.config['RELOAD_WINDOW'], app.config['RELOAD_MIN_INTERVAL'])
+sieve.compiler.configure(app.config['SIEVE_COMPILE_WORKERS'], app.config['SIEVE_COMPILE_CACHE_SIZE'])
+lock.manager.configure(app.config['LOCK_DIR'], app.config['LOCK_TIMEOUT'])
+postfix.map_type = app.config['POSTFIX_MAP_TYPE']
+
+def database_options():
+    """Settings of the connections to the database."""
+    return dict(busy_timeout=app.config['DATABASE_BUSY_TIMEOUT'],
+            cache_size=app.config['DATABASE_CACHE_SIZE'],
+            mmap_size=app.config['DATABASE_MMAP_SIZE'],
+            statement_cache_size=app.config['DATABASE_STATEMENT_CACHE_SIZE'])
+
+# One long-lived connection per worker thread
+db_manager = database.ConnectionManager(app.config['DATABASE'], **database_options())
+
 def connect_db():
     """Connects to the specific database."""
-    rv = sqlite3.connect(app.config['DATABASE'])
-    rv.row_factory = sqlite3.Row
-    return rv
+    return database.connect(app.config['DATABASE'], **database_options())
 
 def get_db():
-    """Opens a new database connection if there is none yet for the
+    """Returns the connection of the current thread for the
     current application context.
     """
     if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
+        g.sqlite_db = db_manager.get()
     return g.sqlite_db
 
 @app.teardown_appcontext
 def close_db(error):
-    """Closes the database again at the end of the request."""
+    """Rolls back what the request didn't commit, the connection is kept for the next one."""
     if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+        db_manager.release()
 
-def init_db():
-    db = get_db()
-    with app.open_resource('db/schema.sql', mode='r') as f:
-        db.cursor().executescript(f.read())
-        db.commit()
+def init_db( db, reset=False ) :
+    """Brings the database schema up to date, dropping everything first if reset."""
+
+    if reset :
+        migrations.reset( db )
+    # The passwords were only in the passwd file before
+    applied = migrations.migrate( db, passwd_file_path=app.config['PASSWD_FILE_PATH'] )
+    for version, description, function in migrations.MIGRATIONS :
+        if version in applied :
+            log( 'Applied migration '+str( version )+' : '+description )
+    search.create_index( db )
+    return applied
 
 @app.cli.command('initdb')
-def initdb_command():
-    """Initializes the database. Meant to be used as a flask command."""
-    init_db()
-    log('Initialized the database.')
+@click.option('--reset', is_flag=True, help='Drop all the existing data first.')
+def initdb_command( reset ) :
+    """Initializes or upgrades the database. Meant to be used as a flask command."""
+
+    if reset :
+        click.confirm( 'Delete all the users and mails ?', abort=True )
+    init_db( get_db(), reset )
+    log( 'Database schema at version '+str( migrations.get_version( get_db() ) )+'.' )
+
+@app.cli.command('importpasswd')
+def importpasswd_command() :
+    """Copies the passwords of the passwd file into the mailboxes of the database that have none."""
+
+    db = get_db()
+    with db :
+        count = migrations.import_passwd_file( db, app.config['PASSWD_FILE_PATH'] )
+    log( 'Imported '+str( count )+' passwords from '+app.config['PASSWD_FILE_PATH']+'.' )
+
+@app.cli.command('initsearch')
+def initsearch_command() :
+    """Creates the address search index in an existing database."""
+
+    if search.create_index( get_db() ) :
+        log( 'Initialized the search index.' )
+    else :
+        log( 'This SQLite has no FTS5 trigram support, searches will scan the table.', level='WARNING' )
+
+@app.cli.command('lookupd')
+def lookupd_command() :
+    """Serve the postfix virtual maps from the database (socketmap protocol)."""
+
+    lookup = MailsLookup( app.config['DATABASE'], app.config['LOOKUP_CACHE_SIZE'], **database_options() )
+    server = SocketmapServer( ( app.config['LOOKUP_HOST'], app.config['LOOKUP_PORT'] ), lookup )
+    log( 'Lookup server listening on '+app.config['LOOKUP_HOST']+':'+str( app.config['LOOKUP_PORT'] ) )
+    server.serve_forever()
+
+@app.cli.command('dictd')
+def dictd_command() :
+    """Serve the mailboxes passwords to dovecot from the database (dict-proxy protocol)."""
+
+    lookup = MailsLookup( app.config['DATABASE'], app.config['LOOKUP_CACHE_SIZE'], **database_options() )
+    server = DictServer( app.config['DICT_SOCKET_PATH'], lookup )
+    log( 'Dict server listening on '+app.config['DICT_SOCKET_PATH'] )
+    server.serve_forever()
+
+@app.cli.command('lookup')
+@click.argument('name')
+@click.argument('key')
+def lookup_command( name, key ) :
+    """Query the lookup server like postfix would do."""
+
+    client = SocketmapClient( app.config['LOOKUP_HOST'], app.config['LOOKUP_PORT'] )
+    status, data = client.lookup( name, key.decode( 'utf-8' ) )
+    client.close()
+    click.echo( status+' '+data )
+
+def transfer_format( path, fmt ) :
+    """The format asked for or guessed from the file extension"""
+
+    if fmt :
+        return fmt
+    return 'jsonl' if path.endswith( '.jsonl' ) else 'csv'
+
+@app.cli.command('export')
+@click.argument('output', default='-')
+@click.option('--format', 'fmt', type=click.Choice(transfer.FORMATS), help='Default guessed from the extension, csv for stdout.')
+def export_command( output, fmt ) :
+    """Exports the mailboxes, aliases, end dates and hashed passwords."""
+
+    fmt = transfer_format( output, fmt )
+    rows = transfer.export_rows( get_db() )
+    if output == '-' :
+        count = transfer.write_rows( click.get_binary_stream( 'stdout' ), fmt, rows )
+    else :
+        with open( output, 'wb' ) as f :
+            count = transfer.write_rows( f, fmt, rows )
+    log( 'Exported '+str( count )+' mails.' )
+
+@app.cli.command('import')
+@click.argument('input', default='-')
+@click.option('--format', 'fmt', type=click.Choice(transfer.FORMATS), help='Default guessed from the extension, csv for stdin.')
+@click.option('--chunk-size', default=500, help='Rows inserted per transaction (500 at most).')
+def import_command( input, fmt, chunk_size ) :
+    """Imports mailboxes, aliases, end dates and hashed passwords, then publishes them."""
+
+    fmt = transfer_format( input, fmt )
+
+    def report( number, reason ) :
+        log( 'Row '+str( number )+' skipped : '+reason.encode( 'utf-8' ), level='WARNING' )
+
+    f = click.get_binary_stream( 'stdin' ) if input == '-' else open( input, 'rb' )
+    try :
+        imported, skipped = transfer.import_rows( get_db(),
+                transfer.read_rows( f, fmt ), min( chunk_size, 500 ), report )
+    finally :
+        if f is not click.get_binary_stream( 'stdin' ) :
+            f.close()
+    log( 'Imported '+str( imported )+' mails, skipped '+str( skipped )+'.' )
 
-def initdb_python():
+    if not update_postfix_mails() :
+        log( 'Something went wrong while updating postfix. Check the logs for more details.', level='ERROR' )
+
+def initdb_python() :
     """Initialize the database. Meant to be used in python scripts."""
-    db = sqlite3.connect(app.config['DATABASE'])
-    db.row_factory = sqlite3.Row
-    with app.open_resource('db/schema.sql', mode='r') as f:
-        db.cursor().executescript(f.read())
-        db.commit()
+
+    db = connect_db()
+    init_db( db )
     db.close()
 
 
@@ -87,60 +218,408 @@ def log (message, level='INFO') :
     return None
 
 
+@app.template_filter('datetime')
+def format_timestamp (timestamp) :
+    """Format a unix timestamp as a local date for the templates"""
+
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+@app.template_filter('end_date')
+def format_end_date (timestamp) :
+    """Format the end date of a mail for the templates"""
+
+    return dates.format_date(timestamp)
+
+
+def changes_since( db, seq ) :
+    """Return the addresses of the mails changed since seq, None if seq is None
+    or too many changes, or pruned ones, would have to be read"""
+
+    if seq is None :
+        return None
+    rows, complete = changes.since( db, seq, app.config['CHANGES_DELTA_LIMIT'], kind='mail' )
+    if not complete or len( rows ) >= app.config['CHANGES_DELTA_LIMIT'] :
+        return None
+    return set( row['address'] for row in rows )
+
+def select_in( db, query, addresses ) :
+    """Run query, ending with 'IN', for the addresses by chunks under the SQLite arguments limit"""
+
+    addresses = list( addresses )
+    rows = []
+    for i in range( 0, len( addresses ), 500 ) :
+        chunk = addresses[i:i+500]
+        rows += db.execute( query+' ('+','.join( '?' * len( chunk ) )+')', chunk ).fetchall()
+    return rows
+
+def published_fields( path, separator, addresses ) :
+    """Return the fields of the lines of a published file, except the lines of the addresses"""
+
+    fields = ( tuple( entry.split( separator, 1 ) ) for entry in publish.read_entries( path ) )
+    return [ f for f in fields if f[0] not in addresses ]
+
+def prune_changes( db ) :
+    """Keep the last CHANGES_HISTORY changes. Consumers further behind read everything again"""
+
+    changes.prune( db, app.config['CHANGES_HISTORY'] )
+    db.commit()
+
 def update_postfix_mails() :
     """Get all mails info and trigger the postfix.update function with it"""
 
-    db = get_db()
-    
-    cur = db.execute('SELECT m1.address as a1, m2.address as a2 FROM mails as m1 JOIN mails as m2 ON m1.target_id=m2.id OR m1.target_id ISNULL AND m1.address=m2.address')
-    aliases_dict = cur.fetchall()
-    aliases_list = [ (a['a1'], a['a2']) for a in aliases_dict ]
+    # Only one worker publishes at a time so the files match the cursor
+    try :
+        with lock.locked( app.config['DATABASE'] ) :
+            prune_changes( get_db() )
+            return _update_postfix_mails( get_db() )
+    except lock.LockTimeout as e :
+        log( 'update_postfix_mails : '+str( e ), level='ERROR' )
+        return False
+
+def _update_postfix_mails( db ) :
+    # Read before the mails so a change made meanwhile is published again next time
+    seq = changes.latest( db )
+
+    # Files to replicate to the other nodes
+    published = []
+    # A failure of the maps doesn't keep the passwd file from being published
+    success = True
+
+    # Postfix may get the mails from the lookup server instead of the files
+    if app.config['PUBLISH_POSTFIX_MAPS'] :
+        addresses = changes_since( db, changes.get_cursor( db, 'postfix_maps' ) )
+        if addresses is None or not os.path.exists( app.config['ALIASES_FILE_PATH'] ) \
+                or not os.path.exists( app.config['MAILBOXES_FILE_PATH'] ) :
+            cur = db.execute('SELECT m1.address as a1, m2.address as a2 FROM mails as m1 JOIN mails as m2 ON m1.target_id=m2.id OR m1.target_id ISNULL AND m1.address=m2.address')
+            aliases_list = [ (a['a1'], a['a2']) for a in cur ]
+            cur = db.execute('SELECT address FROM mails WHERE target_id ISNULL')
+            mailboxes_list = [ m['address'] for m in cur ]
+        else :
+            # Only the lines of the changed addresses are read again
+            aliases_list = published_fields( app.config['ALIASES_FILE_PATH'], ' ', addresses )
+            aliases_list += [ (a['a1'], a['a2']) for a in select_in( db, 'SELECT m1.address as a1, m2.address as a2 FROM mails as m1 JOIN mails as m2 ON (m1.target_id=m2.id OR m1.target_id ISNULL AND m1.address=m2.address) WHERE m1.address IN', addresses ) ]
+            mailboxes_list = [ f[0] for f in published_fields( app.config['MAILBOXES_FILE_PATH'], ' ', addresses ) ]
+            mailboxes_list += [ m['address'] for m in select_in( db, 'SELECT address FROM mails WHERE target_id ISNULL AND address IN', addresses ) ]
+
+        result = postfix.update(app.config['ALIASES_FILE_PATH'],
+                app.config['MAILBOXES_FILE_PATH'], aliases_list, mailboxes_list )
+        if not result[0] :
+            log( 'update_postfix_mails : '+result[1], level='ERROR' )
+            success = False
+        else :
+            for name, path in ( ( 'aliases', app.config['ALIASES_FILE_PATH'] ),
+                    ( 'mailboxes', app.config['MAILBOXES_FILE_PATH'] ) ) :
+                added, removed = result[1][name]
+                if added or removed :
+                    published.append( path )
+            changes.set_cursor( db, 'postfix_maps', seq )
+            db.commit()
+
+    # Dovecot may get the passwords from the dict server instead of the file
+    if app.config['PUBLISH_PASSWD_FILE'] :
+        addresses = changes_since( db, changes.get_cursor( db, 'passwd' ) )
+        # After a failure the whole file is published again, the lines of
+        # the removed mailboxes included
+        if addresses is None or dovecot.sync_needed() \
+                or not os.path.exists( app.config['PASSWD_FILE_PATH'] ) :
+            mailboxes_dict = db.execute('SELECT address, password FROM mails WHERE target_id ISNULL').fetchall()
+            passwds_list = []
+        else :
+            mailboxes_dict = select_in( db, 'SELECT address, password FROM mails WHERE target_id ISNULL AND address IN', addresses )
+            passwds_list = published_fields( app.config['PASSWD_FILE_PATH'], ':', addresses )
+
+        # A mailbox without a password in the database keeps the one of the file
+        published_passwds = dict( published_fields( app.config['PASSWD_FILE_PATH'], ':', () ) )
+        for m in mailboxes_dict :
+            if m['password'] :
+                passwds_list.append( ( m['address'], m['password'] ) )
+            elif m['address'] in published_passwds :
+                passwds_list.append( ( m['address'], published_passwds[m['address']] ) )
+
+        result = dovecot.sync_passwd( app.config['PASSWD_FILE_PATH'], passwds_list )
+        if not result[0] :
+            log( 'update_postfix_mails : '+result[1], level='ERROR' )
+            success = False
+        else :
+            added, removed = result[1]
+            if added or removed :
+                log( 'Published the passwd file, '+str( len( added ) )+' lines added and '+str( len( removed ) )+' removed' )
+                published.append( app.config['PASSWD_FILE_PATH'] )
+            changes.set_cursor( db, 'passwd', seq )
+            db.commit()
+
+    # What was published is replicated even if the rest failed
+    return replicate( published ) and success
+
+# Journal of the published files pulled by the other nodes, None without replication
+journal = None
+if app.config['REPLICATION_DIR'] :
+    journal = replication.Journal( app.config['REPLICATION_DIR'], app.config['REPLICATION_HISTORY'] )
+
+def replication_files( paths=None ) :
+    """Return the replicated names of the given published files, and of the files
+    built from them, as a { name : path } dict and the { name : path } of the files
+    they are built from. All the files, sieve scripts included, if paths is None"""
+
+    maps = [ app.config['ALIASES_FILE_PATH'], app.config['MAILBOXES_FILE_PATH'] ]
+    if paths is None :
+        paths = maps + [ app.config['PASSWD_FILE_PATH'] ]
+        for root, dirs, filenames in os.walk( app.config['VMAIL_DIR'] ) :
+            if app.config['SIEVE_FILENAME'] in filenames :
+                paths.append( os.path.join( root, app.config['SIEVE_FILENAME'] ) )
+
+    files = {}
+    built_from = {}
+    for path in paths :
+        if path in maps :
+            name = 'postfix/'+os.path.basename( path )
+            files[name] = path
+            for suffix in postfix.MAP_SUFFIXES.get( postfix.map_type, [] ) :
+                files[name+suffix] = path+suffix
+                built_from[name+suffix] = path
+        elif path == app.config['PASSWD_FILE_PATH'] :
+            files['dovecot/'+os.path.basename( path )] = path
+        else :
+            # Sieve script and its binary, locked together
+            name = 'vmail/'+os.path.relpath( path, app.config['VMAIL_DIR'] ).replace( os.sep, '/' )
+            files[name] = path
+            binary_path = sieve.get_binary_filepath( path )
+            binary_name = 'vmail/'+os.path.relpath( binary_path, app.config['VMAIL_DIR'] ).replace( os.sep, '/' )
+            files[binary_name] = binary_path
+            built_from[binary_name] = path
+    return files, built_from
+
+def replicate( paths=None ) :
+    """Record the published files in the replication journal, all of them if
+    paths is None or nothing was recorded yet. Return False on failure"""
+
+    if journal is None :
+        return True
+    if not paths and paths is not None :
+        return True
 
-    cur = db.execute('SELECT address FROM mails WHERE target_id ISNULL')
-    mailboxes_dict = cur.fetchall()
-    mailboxes_list = [ m['address'] for m in mailboxes_dict ]
+    try :
+        if journal.head() == 0 :
+            paths = None
+        version = journal.record( *replication_files( paths ) )
+    except ( replication.ReplicationError, lock.LockTimeout, IOError, OSError ) as e :
+        log( 'replicate : '+str( e ), level='ERROR' )
+        return False
 
-    result = postfix.update(app.config['ALIASES_FILE_PATH'],
-            app.config['MAILBOXES_FILE_PATH'], aliases_list, mailboxes_list )
-    if not result[0] :
-        log( 'update_postfix_mails : '+result[1], level='ERROR' )
-        return result[0]
+    log( 'Replication journal at version '+str( version ) )
+    return True
 
-    result = dovecot.remove_unexisting( app.config['PASSWD_FILE_PATH'], mailboxes_list )
-    if not result[0] :
-        log( 'update_postfix_mails : '+result[1], level='ERROR' )
-        return result[0]
+def publish_mails() :
+    """Publish the mails from outside of a request. Used by the sync worker"""
 
-    return result[0]
+    with app.app_context() :
+        try :
+            return update_postfix_mails()
+        except :
+            log( sys.exc_info(), level='ERROR' )
+            return False
 
-def add_dovecot_passwd( mailbox_add, pw ) :
-    """Triggers the dovecot.update_passwd function with the right infos"""
-    
-    result = dovecot.add_passwd(app.config['PASSWD_FILE_PATH'], mailbox_add, pw)
-    if not result[0] :
-        log( 'add_dovecot_passwd : '+result[1], level='ERROR' )
+sync_worker = SyncWorker( publish_mails, app.config['SYNC_DEBOUNCE'],
+        app.config['SYNC_MAX_LATENCY'] )
+
+def sync_postfix_mails() :
+    """Publish the mails now or let the sync worker publish them with the next burst.
+    Return False only if an immediate publication failed"""
+
+    if not app.config['SYNC_IN_BACKGROUND'] :
+        return update_postfix_mails()
+
+    sync_worker.mark_dirty()
+    return True
+
+def expire_mails( now=None ) :
+    """Delete the mails whose end date is passed, and the aliases of these mailboxes,
+    in a single transaction. Return the deleted addresses"""
+
+    if now is None :
+        now = int( time.time() )
+
+    db = get_db()
+    # Nobody can change the expired mails between the listing and the deletion
+    db.execute( 'BEGIN IMMEDIATE' )
+    try :
+        cur = db.execute( 'SELECT address FROM mails WHERE end_date < ?'
+                ' OR target_id IN ( SELECT id FROM mails WHERE end_date < ? )', [now, now] )
+        addresses = [ row['address'] for row in cur ]
+        # The aliases of the expired mailboxes are deleted by the foreign key
+        db.execute( 'DELETE FROM mails WHERE end_date < ?', [now] )
+        db.commit()
+    except :
+        db.rollback()
+        raise
+    return addresses
+
+def del_tmp_mails() :
+    """Deletes the outdated temporary mails and publishes the mail server files."""
 
-    return result[0]
+    log( '==> Starting to delete outdated temporary mails <==' )
+    try :
+        addresses = expire_mails()
+    except sqlite3.Error :
+        log( sys.exc_info(), level='ERROR' )
+        log( 'Not updating postfix because an error occured previously' )
+        return
+    for address in addresses :
+        log( 'Successfully deleted '+address )
+    if not addresses :
+        log( 'Nothing to delete' )
+    # The process ends right after, don't leave it to the sync worker
+    elif not update_postfix_mails() :
+        log( 'Something went wrong while updating postfix. Check the logs for more details.', level='ERROR' )
+    log( '==> Ending deletion of outdated temporary mails <==' )
+
+@app.cli.command('expire')
+def expire_command() :
+    """Deletes the outdated temporary mails. Meant to be used as a flask command."""
+
+    del_tmp_mails()
+
+def load_end_dates( cursor=None ) :
+    """Return the end dates set since the cursor, a sequence number of the changes,
+    all of them if cursor is None, and the new cursor. Used by the expiry scheduler"""
+
+    with app.app_context() :
+        db = get_db()
+        seq = changes.latest( db )
+        if cursor is not None :
+            rows, complete = changes.since( db, cursor, app.config['CHANGES_DELTA_LIMIT'], kind='mail' )
+            if complete and len( rows ) < app.config['CHANGES_DELTA_LIMIT'] :
+                return ( [ row['end_date'] for row in rows if row['end_date'] is not None ],
+                        rows[-1]['seq'] if rows else cursor )
+
+        # Read from the end_date index only
+        cur = db.execute( 'SELECT DISTINCT end_date FROM mails WHERE end_date NOTNULL' )
+        return ( [ row[0] for row in cur ], seq )
+
+def expire_in_background() :
+    """Delete the expired mails from outside of a request. Used by the expiry scheduler.
+    Return the number of deleted addresses, None on failure"""
+
+    with app.app_context() :
+        try :
+            addresses = expire_mails()
+            for address in addresses :
+                log( 'Expired '+address )
+            if addresses and not sync_postfix_mails() :
+                log( 'Something went wrong while updating postfix. Check the logs for more details.', level='ERROR' )
+            return len( addresses )
+        except :
+            log( sys.exc_info(), level='ERROR' )
+            return None
+
+# The end dates set by the other workers and commands are read from the changes journal
+expiry_scheduler = ExpiryScheduler( load_end_dates, expire_in_background, app.config['EXPIRY_REFRESH'] )
+
+@app.before_request
+def start_expiry_scheduler() :
+    """Make sure this worker deletes the mails when they expire"""
+
+    if app.config['EXPIRY_IN_BACKGROUND'] :
+        expiry_scheduler.start()
+
+def schedule_expiry( end_date ) :
+    """Wake the expiry scheduler up for an end date (a timestamp) just set"""
+
+    if app.config['EXPIRY_IN_BACKGROUND'] :
+        expiry_scheduler.schedule( end_date )
+
+@app.cli.command('expired')
+@click.option('--refresh', default=60, help='Seconds between two readings of the end dates.')
+def expired_command( refresh ) :
+    """Deletes the mails as soon as they expire, until interrupted."""
+
+    # The edits of the web workers don't wake this process up
+    scheduler = ExpiryScheduler( load_end_dates, expire_in_background, refresh )
+    scheduler.start()
+    log( 'Expiry scheduler started.' )
+    while scheduler.thread.is_alive() :
+        scheduler.thread.join( 1 )
+
+@app.cli.command('changes')
+@click.option('--since', default=0, help='Sequence number of the last change already seen.')
+@click.option('--limit', default=100, help='Maximum number of changes listed.')
+def changes_command( since, limit ) :
+    """Lists the changes of the mails and filters after a sequence number."""
+
+    rows, complete = changes.since( get_db(), since, limit )
+    if not complete :
+        log( 'Some changes after '+str( since )+' were pruned.', level='WARNING' )
+    for row in rows :
+        click.echo( '\t'.join( [ str( row['seq'] ), dates.format_date( row['changed_at'] ), row['kind'],
+            row['op'], row['address'], dates.format_date( row['end_date'] ) or '' ] ) )
+
+@app.cli.command('replicate')
+def replicate_command() :
+    """Records all the published files, sieve scripts included, in the replication journal."""
+
+    if journal is None :
+        log( 'REPLICATION_DIR is not set.', level='ERROR' )
+        return
+    replicate()
+
+@app.cli.command('replica')
+@click.option('--once', is_flag=True, help='Apply the latest version and exit.')
+def replica_command( once ) :
+    """Applies the files published by the main node to this one, until interrupted."""
+
+    source = app.config['REPLICATION_SOURCE']
+    if source.startswith( 'http://' ) or source.startswith( 'https://' ) :
+        source = replication.HttpSource( source, app.config['REPLICATION_TOKEN'] )
+    else :
+        source = replication.JournalSource( replication.Journal( source ) )
+    agent = replication.Agent( source, app.config['REPLICATION_TARGETS'],
+            app.config['REPLICATION_STATE'], app.config['REPLICATION_NODE'] or socket.gethostname() )
+
+    version = None
+    while True :
+        result = agent.run_once()
+        if not result[0] :
+            log( 'replica : '+result[1], level='ERROR' )
+        elif result[1] != version :
+            version = result[1]
+            log( 'Replica at version '+str( version ) )
+        if once :
+            return
+        time.sleep( app.config['REPLICATION_INTERVAL'] )
 
 def check_dovecot_passwd( mailbox_add, pw ) :
-    """Triggers the dovecot.check_passwd function with the right infos"""
+    """Check the password against the hash of the mailbox in the database"""
 
-    return dovecot.check_passwd(app.config['PASSWD_FILE_PATH'], mailbox_add, pw)
+    cur = get_db().execute('SELECT password FROM mails WHERE address=? AND target_id ISNULL', [mailbox_add])
+    mailbox = cur.fetchone()
+    if mailbox is None or not mailbox['password'] :
+        return False
+    return dovecot.verify_passwd(pw, mailbox['password'])
 
 def change_dovecot_passwd( mailbox_add, pw ) :
-    """Triggers the dovecot.change_passwd function with the right infos"""
+    """Store the hash of the new password of the mailbox and publish it"""
 
-    result = dovecot.change_passwd(app.config['PASSWD_FILE_PATH'], mailbox_add, pw)
-    if not result[0] :
-        log( 'change_dovecot_passwd : '+result[1], level='ERROR' )
+    db = get_db()
+    try :
+        db.execute('UPDATE mails SET password=? WHERE address=? AND target_id ISNULL',
+                [dovecot.hash_passwd(pw), mailbox_add])
+        db.commit()
+    except sqlite3.Error :
+        log( sys.exc_info(), level='ERROR' )
+        return False
 
-    return result[0]
+    return sync_postfix_mails()
+
+filter_index = sieve.FilterIndex( app.config['VMAIL_DIR'],
+        app.config['SIEVE_FILENAME'], app.config['EXCLUDE_DIRS'],
+        app.config['FILTER_INDEX_PATH'], app.config['FILTER_INDEX_WORKERS'] )
 
 def get_sieve_filter_list( ) :
-    """Trigger the sieve.get_filter_list function with the right infos"""
+    """Return the mailboxes found in the vmail tree with their sieve file path
+    and whether it exists, from the shared index"""
 
-    return sieve.get_filter_list( app.config['VMAIL_DIR'],
-            app.config['SIEVE_FILENAME'], app.config['EXCLUDE_DIRS'] )
+    return filter_index.get()
 
 def get_sieve_filter_content( mailbox ) :
     """Triggers the sieve.get_filter_content_from_mailbox with the right infos"""
@@ -155,8 +634,15 @@ def set_sieve_filter_content( mailbox, content ) :
             mailbox, app.config['SIEVE_FILENAME'], content )
     if not result[0] :
         log( 'set_sieve_filter_content : '+result[1], level='ERROR' )
+        return result[0]
 
-    return result[0]
+    filter_index.set_exists( mailbox )
+    db = get_db()
+    changes.record( db, 'filter', 'update', mailbox )
+    db.commit()
+    prune_changes( db )
+    return replicate( [ sieve.get_filter_filepath_from_mailbox( app.config['VMAIL_DIR'],
+            mailbox, app.config['SIEVE_FILENAME'] ) ] )
 
 def check_sieve_filter_content( content ):
     """Triggers the sieve.check_filter_content with the right infos"""
@@ -180,31 +666,374 @@ def folders():
     
 @app.route('/mails/', methods=['GET'])
 def mails():
-    """The web page presenting the different mail infos"""
+    """The web page presenting the different mail infos
+    Mailboxes are listed by pages of MAILS_PAGE_SIZE starting after the address
+    given in 'after' and can be searched by prefix or substring with 'q'"""
 
     if not session.get('user_id') :
         return redirect( url_for( 'login', redir='mails' ) )
 
+    after = request.args.get('after', '')
+    search_text = request.args.get('q', '')
+    match = request.args.get('match', 'substring')
+    page_size = app.config['MAILS_PAGE_SIZE']
+
+    # Select one more mailbox than needed to know if there is a next page
+    conditions = [ 'target_id ISNULL', 'address > ?' ]
+    args = [ after ]
+    if search_text and match == 'prefix' :
+        # A range on the address so the unique index is used
+        conditions.append( 'address >= ? AND address < ?' )
+        args += [ search_text, search_text + u'\U0010ffff' ]
+    elif search_text :
+        # The mailbox or one of its aliases contains the searched string
+        conditions.append( "( address LIKE ? ESCAPE '\\' OR EXISTS ( SELECT 1 FROM mails AS s"
+                " WHERE s.target_id=mails.id AND s.address LIKE ? ESCAPE '\\' ) )" )
+        args += [ '%'+search.escape_like(search_text)+'%' ] * 2
+    args.append( page_size + 1 )
+
     # Get the mailboxes and aliases from database (mails = mailboxes + aliases)
+    db = get_db()
+    cur = db.execute('SELECT mb.id AS mb_id, mb.address AS mb_address, mb.end_date AS mb_end_date,'
+            ' a.id AS id, a.address AS address, a.end_date AS end_date'
+            ' FROM ( SELECT id, address, end_date FROM mails WHERE ' + ' AND '.join( conditions ) +
+            ' ORDER BY address LIMIT ? ) AS mb'
+            ' LEFT JOIN mails AS a ON a.target_id=mb.id'
+            ' ORDER BY mb.address, a.address', args)
+
+    # Group the aliases with their mailbox
     mails = []
+    for row in cur :
+        if not mails or mails[-1]['id'] != row['mb_id'] :
+            mails.append ({'address': row['mb_address'],
+                            'id': row['mb_id'],
+                            'end_date' : row['mb_end_date'],
+                            'aliases' : []})
+        if row['id'] is not None :
+            mails[-1]['aliases'].append( row )
 
-    db = get_db()
+    # Cursor of the next page
+    next_after = None
+    if len( mails ) > page_size :
+        mails = mails[:page_size]
+        next_after = mails[-1]['address']
 
-    cur = db.execute('SELECT id, address, end_date FROM mails WHERE target_id ISNULL')
-    mailboxes = cur.fetchall()
+    return render_template('mails.html', mails=mails, sync=sync_worker.status(),
+            search=search_text, match=match, after=after, next_after=next_after)
+
+
+
+@app.route('/status/', methods=['GET'])
+def status():
+    """State of the background tasks, as JSON"""
+
+    if not session.get('user_id') :
+        return redirect( url_for( 'login', redir='mails' ) )
+
+    return jsonify( sync=sync_worker.status(), expiry=expiry_scheduler.status(),
+            reloads=services.manager.stats(), locks=lock.manager.stats(),
+            sieve=sieve.compiler.stats(), database=db_manager.stats(),
+            replication=journal.status() if journal is not None else None )
+
+
+
+def check_replication_token():
+    """Only the agents of the other nodes, knowing the token, may pull the journal"""
+
+    if journal is None or not app.config['REPLICATION_TOKEN'] :
+        abort( 404 )
+    token = request.headers.get( 'Authorization', '' )[len( 'Bearer ' ):]
+    if not hmac.compare_digest( token.encode( 'utf-8' ), app.config['REPLICATION_TOKEN'].encode( 'utf-8' ) ) :
+        abort( 403 )
+
+@app.route('/replication/delta', methods=['GET'])
+def replication_delta():
+    """The files changed since the version given by 'since', as JSON"""
+
+    check_replication_token()
+    try :
+        since = int( request.args.get( 'since', 0 ) )
+    except ValueError :
+        return jsonify( error='since must be a number' ), 400
+    try :
+        return jsonify( journal.delta( since ) )
+    except replication.ReplicationError as e :
+        return jsonify( error=str( e ) ), 500
+
+@app.route('/replication/blobs/<sha>', methods=['GET'])
+def replication_blob( sha ):
+    """The content of a version of a file"""
+
+    check_replication_token()
+    try :
+        return Response( journal.blob( sha ), mimetype='application/octet-stream' )
+    except replication.ReplicationError :
+        abort( 404 )
 
-    for mailbox in mailboxes :
-        cur = db.execute('SELECT id, address, end_date FROM mails WHERE target_id=?',
-                [mailbox['id']])
-        aliases = cur.fetchall()
+@app.route('/replication/nodes/<node>', methods=['POST'])
+def replication_report( node ):
+    """Save the version applied by a node"""
 
-        mails.append ({'address': mailbox['address'],
-                        'id': mailbox['id'],
-                        'end_date' : mailbox['end_date'],
-                        'aliases' : aliases})
+    check_replication_token()
+    data = request.get_json( silent=True ) or {}
+    try :
+        journal.report( node, int( data.get( 'version', 0 ) ), data.get( 'error' ) )
+    except ( replication.ReplicationError, ValueError ) as e :
+        return jsonify( error=str( e ) ), 400
+    return jsonify( ok=True )
+
+
+
+@app.route('/changes/', methods=['GET'])
+def list_changes():
+    """Changes of the mails and filters after the sequence number 'since', as JSON.
+    'complete' is false when some of them were pruned, the mails have to be read again"""
+
+    if not session.get('user_id') :
+        return redirect( url_for( 'login', redir='list_changes' ) )
+
+    try :
+        since = int( request.args.get('since', 0) )
+        limit = int( request.args.get('limit', 1000) )
+    except ValueError :
+        return jsonify( error='since and limit must be numbers' ), 400
+
+    rows, complete = changes.since( get_db(), since, min( limit, 10000 ), request.args.get('kind') )
+    return jsonify( changes=[ dict( zip( row.keys(), row ) ) for row in rows ],
+            complete=complete, latest=changes.latest( get_db() ) )
+
+
+
+@app.route('/search/', methods=['GET'])
+def search_addresses():
+    """Search the mails by substring ('q'), domain ('domain') and end date
+    ('expires_before', as YYYY-MM-DD or YYYY-MM-DD HH:MM:SS), as JSON"""
+
+    if not session.get('user_id') :
+        return redirect( url_for( 'login', redir='mails' ) )
+
+    expires_before = None
+    if request.args.get('expires_before') :
+        date = request.args.get('expires_before')
+        try :
+            if len( date ) > len( 'YYYY-MM-DD' ) :
+                expires_before = dates.parse_date( date )
+            else :
+                expires_before = dates.parse_date( date, "%Y-%m-%d" )
+        except ValueError :
+            return jsonify( error='expires_before must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS' ), 400
+
+    try :
+        limit = int( request.args.get('limit', 100) )
+    except ValueError :
+        return jsonify( error='limit must be a number' ), 400
 
-    return render_template('mails.html', mails=mails)
+    results = search.search_mails( get_db(), request.args.get('q'),
+            request.args.get('domain'), expires_before, min( limit, 1000 ) )
 
+    return jsonify( results=[ dict( zip( row.keys(), row ) ) for row in results ] )
+
+
+
+def parse_end_date( value ) :
+    """Return the timestamp of an end date given as YYYY-MM-DD HH:MM:SS UTC,
+    None means no end date"""
+
+    if value is None :
+        return None
+    return dates.parse_date( value )
+
+
+class BulkValidator :
+    """Check a batch of operations against the database and against each other,
+    keeping track of what each address will be after the operations checked so far"""
+
+    def __init__( self, db ) :
+        self.db = db
+        # address -> 'mailbox', 'alias' or None (deleted) once the batch is applied
+        self.state = {}
+        # Aliases added by the batch with their mailbox
+        self.aliases = {}
+        # Domains already checked for deliverability
+        self.deliverable = {}
+
+    def initial_kind( self, address ) :
+        """What the address is in the database"""
+
+        row = self.db.execute( 'SELECT target_id FROM mails WHERE address=?', [address] ).fetchone()
+        if row is None :
+            return None
+        return 'alias' if row['target_id'] else 'mailbox'
+
+    def kind( self, address ) :
+        """What the address is after the operations checked so far"""
+
+        if address in self.state :
+            return self.state[address]
+        return self.initial_kind( address )
+
+    def normalize( self, address ) :
+        """Return the normalized address, raise EmailNotValidError if it's not valid.
+        The DNS is only queried once per domain"""
+
+        v = validate_email( address, check_deliverability=False )
+        if v['domain'] not in self.deliverable :
+            try :
+                validate_email( v['email'] )
+            except EmailNotValidError :
+                self.deliverable[v['domain']] = False
+            else :
+                self.deliverable[v['domain']] = True
+        if not self.deliverable[v['domain']] :
+            raise EmailNotValidError( 'The domain '+v['domain']+' can\'t receive mails' )
+        return v['email']
+
+    def check( self, operation ) :
+        """Return the normalized operation, raise ValueError with the reason if it's not valid"""
+
+        if not isinstance( operation, dict ) or not isinstance( operation.get('address'), basestring ) :
+            raise ValueError( 'An operation must be an object with an address' )
+        op = operation.get('op')
+        try :
+            address = self.normalize( operation['address'] )
+        except EmailNotValidError as e :
+            # The reason may quote the address, it's unicode
+            raise ValueError( operation['address']+u' is not a valid email : '+unicode( e ) )
+        checked = { 'op' : op, 'address' : address }
+
+        if 'end_date' in operation :
+            try :
+                checked['end_date'] = parse_end_date( operation['end_date'] )
+            except ( ValueError, TypeError ) :
+                raise ValueError( 'end_date must be YYYY-MM-DD HH:MM:SS or null' )
+
+        if op in ( 'add_mailbox', 'add_alias' ) and self.kind( address ) is not None :
+            raise ValueError( 'This mail address is already used' )
+        if op in ( 'update', 'delete' ) and self.kind( address ) is None :
+            raise ValueError( 'This mail address doesn\'t exist' )
+
+        if op == 'add_mailbox' :
+            if not operation.get('password') :
+                raise ValueError( 'A mailbox needs a password' )
+            checked['password'] = operation['password']
+            self.state[address] = 'mailbox'
+
+        elif op == 'add_alias' :
+            if not isinstance( operation.get('mailbox'), basestring ) :
+                raise ValueError( 'An alias needs a mailbox' )
+            try :
+                mailbox = validate_email( operation['mailbox'], check_deliverability=False )['email']
+            except EmailNotValidError as e :
+                raise ValueError( operation['mailbox']+u' is not a valid email : '+unicode( e ) )
+            if self.kind( mailbox ) != 'mailbox' :
+                raise ValueError( operation['mailbox']+' is not a mailbox' )
+            checked['mailbox'] = mailbox
+            self.state[address] = 'alias'
+
+        elif op == 'update' :
+            if operation.get('password') :
+                if self.kind( address ) != 'mailbox' :
+                    raise ValueError( 'Only mailboxes have a password' )
+                checked['password'] = operation['password']
+
+        elif op == 'delete' :
+            if self.kind( address ) == 'mailbox' :
+                # Its aliases go with it
+                cur = self.db.execute( 'SELECT a.address FROM mails AS a JOIN mails AS m'
+                        ' ON a.target_id=m.id WHERE m.address=?', [address] )
+                for row in cur :
+                    self.state[row['address']] = None
+                for alias, target in self.aliases.items() :
+                    if target == address :
+                        self.state[alias] = None
+            self.state[address] = None
+
+        else :
+            raise ValueError( 'Unknown operation, use one of add_mailbox, add_alias, update or delete' )
+
+        if op == 'add_alias' :
+            self.aliases[address] = checked['mailbox']
+        return checked
+
+
+@app.route('/api/bulk', methods=['POST'])
+def bulk() :
+    """Apply a batch of mailboxes and aliases operations given as JSON :
+    {"operations" : [ {"op" : "add_mailbox", "address" : ..., "password" : ..., "end_date" : ...},
+                      {"op" : "add_alias", "address" : ..., "mailbox" : ..., "end_date" : ...},
+                      {"op" : "update", "address" : ..., "password" : ..., "end_date" : ...},
+                      {"op" : "delete", "address" : ...} ]}
+    Every operation is checked first and nothing is done if one of them is wrong.
+    They are then applied in one transaction followed by a single synchronisation"""
+
+    if not session.get('user_id') :
+        return jsonify( error='You must be logged in' ), 401
+
+    data = request.get_json( silent=True )
+    operations = data.get('operations') if isinstance( data, dict ) else data
+    if not isinstance( operations, list ) :
+        return jsonify( error='Expected a JSON object with a list of operations' ), 400
+
+    db = get_db()
+    validator = BulkValidator( db )
+
+    # Check everything before touching anything
+    checked = []
+    results = []
+    for operation in operations :
+        try :
+            checked.append( validator.check( operation ) )
+        except ValueError as e :
+            checked.append( None )
+            results.append( { 'ok' : False, 'error' : unicode( e ) } )
+        else :
+            results.append( { 'ok' : True, 'error' : None } )
+    for operation, result in zip( operations, results ) :
+        if isinstance( operation, dict ) :
+            result['address'] = operation.get('address')
+    if None in checked :
+        return jsonify( applied=False, results=results ), 400
+
+    try :
+        # Commited at the end or rolled back as a whole
+        with db :
+            for op in checked :
+                if op['op'] == 'add_mailbox' :
+                    db.execute( 'INSERT INTO mails (address, end_date, password) VALUES (?, ?, ?)',
+                            [ op['address'], op.get('end_date'), dovecot.hash_passwd( op['password'] ) ] )
+                elif op['op'] == 'add_alias' :
+                    db.execute( 'INSERT INTO mails (address, target_id, end_date) VALUES'
+                            ' (?, (SELECT id FROM mails WHERE address=? AND target_id ISNULL), ?)',
+                            [ op['address'], op['mailbox'], op.get('end_date') ] )
+                elif op['op'] == 'update' :
+                    if 'end_date' in op :
+                        db.execute( 'UPDATE mails SET end_date=? WHERE address=?',
+                                [ op['end_date'], op['address'] ] )
+                    if op.get('password') :
+                        db.execute( 'UPDATE mails SET password=? WHERE address=?',
+                                [ dovecot.hash_passwd( op['password'] ), op['address'] ] )
+                elif op['op'] == 'delete' :
+                    # Its aliases are deleted by the foreign key
+                    db.execute( 'DELETE FROM mails WHERE address=?', [ op['address'] ] )
+    except sqlite3.IntegrityError :
+        log( sys.exc_info(), level='ERROR' )
+        return jsonify( applied=False, results=results,
+                error='The database changed while applying the operations, nothing was done' ), 409
+    except sqlite3.OperationalError :
+        log( sys.exc_info(), level='ERROR' )
+        return jsonify( applied=False, results=results,
+                error='Something went wrong while updating the database' ), 500
+
+    log( str( len( checked ) )+' bulk operations applied' )
+    for op in checked :
+        schedule_expiry( op.get('end_date') )
+
+    # The passwords are published with the mails
+    errors = []
+    if not sync_postfix_mails() :
+        errors.append( 'Something went wrong while updating postfix' )
+
+    return jsonify( applied=True, results=results, errors=errors )
 
 
 @app.route('/addalias/<int:mailbox_id>', methods=['GET', 'POST'])
@@ -246,10 +1075,11 @@ def add_alias(mailbox_id):
                 new_alias = v['email']
                 # If no exceptions so far, let's update the db
                 db.execute('INSERT INTO mails (address, target_id, end_date) VALUES (?, ?, ?)',
-                        [new_alias, mailbox_id, end_date])
+                        [new_alias, mailbox_id, dates.to_timestamp(end_date)])
                 db.commit()
+                schedule_expiry(dates.to_timestamp(end_date))
 
-                if not update_postfix_mails() :
+                if not sync_postfix_mails() :
                     errors.append( Error( PostfixManip,
                         'Something went wrong while updating postfix. Check the logs for more details.' ) )
 
@@ -328,18 +1158,16 @@ def add_mailbox():
 
                 # If no exceptions so far, let's update the db
                 db = get_db()
-                db.execute('INSERT INTO mails (address, end_date) VALUES (?, ?)',
-                        [new_mailbox, end_date])
+                db.execute('INSERT INTO mails (address, end_date, password) VALUES (?, ?, ?)',
+                        [new_mailbox, dates.to_timestamp(end_date),
+                         dovecot.hash_passwd(request.form.get('password1'))])
                 db.commit()
+                schedule_expiry(dates.to_timestamp(end_date))
 
-                # Update the mailboxes files
-                if not update_postfix_mails() :
+                # Update the mailboxes and password files
+                if not sync_postfix_mails() :
                     errors.append( Error( PostfixManip,
                         'Something went wrong while updating postfix. Check the logs for more details.' ) )
-                # Update the password file
-                elif not add_dovecot_passwd(new_mailbox, request.form.get('password1')) :
-                    errors.append( Error( DovecotManip,
-                        'Something went wrong while setting the password. Check the logs for more details.' ) )
 
             except EmailNotValidError :
                 # Only exception from validate_email (= email not valid )
@@ -432,8 +1260,10 @@ def edit_alias(alias_id) :
                             end_date=datetime.strptime(end_str, "%Y-%m-%d-%H-%M-%S")
                         
                         # Update the database
-                        db.execute('UPDATE mails SET end_date=? WHERE id=?', [end_date, alias_id])
+                        db.execute('UPDATE mails SET end_date=? WHERE id=?',
+                                [dates.to_timestamp(end_date), alias_id])
                         db.commit()
+                        schedule_expiry(dates.to_timestamp(end_date))
                     except sqlite3.OperationalError :
                         # Exceptions about database
                         errors.append( Error( DBManip,
@@ -534,8 +1364,9 @@ def edit_mailbox(mailbox_id) :
                     
                     # Update the database
                     db.execute('UPDATE mails SET end_date=? WHERE id=?',
-                            [end_date, mailbox_id])
+                            [dates.to_timestamp(end_date), mailbox_id])
                     db.commit()
+                    schedule_expiry(dates.to_timestamp(end_date))
                 except sqlite3.OperationalError :
                     # Exceptions about database
                     errors.append( Error( DBManip,
@@ -612,7 +1443,7 @@ def del_mail(mail_id) :
                 # You can delete the mail
                 else :
                     del_alias( mail_id )
-                    if not update_postfix_mails() :
+                    if not sync_postfix_mails() :
                         errors.append( Error( PostfixManip,
                             'Something went wrong while updating postfix. Check the logs for more details.' ) )
                     return redirect( url_for( 'mails' ) )
@@ -628,7 +1459,7 @@ def del_mail(mail_id) :
                 # You can delete the mail
                 else :
                     del_mailbox( mail_id )
-                    if not update_postfix_mails() :
+                    if not sync_postfix_mails() :
                         errors.append( Error( PostfixManip,
                             'Something went wrong while updating postfix. Check the logs for more details.' ) )
                     return redirect( url_for( 'mails' ) )
@@ -658,7 +1489,7 @@ def del_mailbox(mailbox_id) :
 
     db = get_db()
     try :
-        db.execute('DELETE FROM mails WHERE target_id=?', [mailbox_id])
+        # Its aliases are deleted by the foreign key
         db.execute('DELETE FROM mails WHERE id=?', [mailbox_id])
         db.commit()
     except :
@@ -683,7 +1514,14 @@ def filters():
     cur = db.execute( 'SELECT id, address FROM mails WHERE target_id ISNULL' )
     mailboxes = cur.fetchall()
 
-    return render_template('filters.html', mailboxes=mailboxes)
+    # Which of them already have a filter
+    try :
+        filter_list = get_sieve_filter_list()
+    except OSError :
+        log (sys.exc_info(), 'Error')
+        filter_list = {}
+
+    return render_template('filters.html', mailboxes=mailboxes, filter_list=filter_list)
 
 
 
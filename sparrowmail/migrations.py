@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""Versioned migrations of the database schema
+
+Each migration runs in its own transaction and is recorded in the
+schema_version table, so running them again only applies the missing ones.
+Foreign keys are not enforced while a migration runs, they are checked
+before it is committed. Migrations are given the options of migrate :
+    passwd_file_path    the dovecot passwd file the passwords come from
+"""
+
+import os
+import time
+import sqlite3
+
+from sparrowmail import search
+from sparrowmail import changes
+
+
+SCHEMA_PATH = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'db', 'schema.sql' )
+
+VERSION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version      integer primary key,
+    description  text    not null,
+    applied_at   integer not null
+)"""
+
+
+def _baseline( db, options ) :
+    """Tables of the first SparrowMail versions from db/schema.sql,
+    kept as they were if they exist. The default user is only
+    added to an empty users table"""
+
+    with open( SCHEMA_PATH, 'r' ) as f :
+        # No trigger in there, each statement ends with a semicolon
+        for statement in f.read().split( ';' ) :
+            if statement.strip() :
+                db.execute( statement )
+
+
+def _mails_indexes( db, options ) :
+    """Alias lookups and deletions seek on target_id, the expiry on end_date"""
+
+    db.execute( 'CREATE INDEX IF NOT EXISTS mails_target_id ON mails (target_id)' )
+    db.execute( 'CREATE INDEX IF NOT EXISTS mails_end_date ON mails (end_date)' )
+
+
+def _mails_foreign_key( db, options ) :
+    """Aliases are deleted with their mailbox.
+    SQLite can't add a constraint to a table so it is rebuilt"""
+
+    seq = db.execute( "SELECT seq FROM sqlite_sequence WHERE name='mails'" ).fetchone()
+
+    db.execute( """
+        CREATE TABLE mails_new (
+            id           integer primary key autoincrement,
+            address      text    not null unique,
+            target_id    integer REFERENCES mails (id) ON DELETE CASCADE,
+            end_date     integer
+        )""" )
+    # Aliases whose mailbox is gone were never delivered, don't keep them
+    db.execute( """
+        INSERT INTO mails_new (id, address, target_id, end_date)
+        SELECT id, address, target_id, end_date FROM mails
+        WHERE target_id ISNULL OR target_id IN ( SELECT id FROM mails )""" )
+    db.execute( 'DROP TABLE mails' )
+    db.execute( 'ALTER TABLE mails_new RENAME TO mails' )
+
+    # Don't give the ids of deleted mails again
+    if seq is not None :
+        db.execute( "UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='mails'", [seq[0]] )
+
+    # Dropped with the old table
+    _mails_indexes( db, options )
+    if search.has_index( db ) :
+        search.create_triggers( db )
+    if changes.has_tables( db ) :
+        changes.create_triggers( db )
+
+
+def _end_date_timestamps( db, options ) :
+    """End dates were stored as the text of python datetimes, compared with
+    CURRENT_TIMESTAMP so they are UTC. Make them integer timestamps"""
+
+    # strftime('%s') reads the fractional seconds and gives NULL for garbage
+    db.execute( """
+        UPDATE mails SET end_date=CAST( strftime( '%s', end_date ) AS integer )
+        WHERE typeof( end_date )='text' AND strftime( '%s', end_date ) NOTNULL""" )
+
+
+def import_passwd_file( db, passwd_file_path ) :
+    """Copy the passwords of the passwd file into the mailboxes that have none,
+    without committing. Return the number of mailboxes that got one.
+    Raise IOError if the file can't be read while there are mailboxes"""
+
+    try :
+        f = open( passwd_file_path, 'rb' )
+    except IOError :
+        # Nothing to lose on a new installation
+        if db.execute( 'SELECT 1 FROM mails WHERE target_id ISNULL LIMIT 1' ).fetchone() is None :
+            return 0
+        raise
+
+    passwds = []
+    with f :
+        for line in f :
+            fields = line.rstrip( '\n' ).split( ':' )
+            if len( fields ) > 1 and fields[1] :
+                passwds.append( ( fields[1].decode( 'utf-8' ), fields[0].decode( 'utf-8' ) ) )
+
+    before = db.total_changes
+    db.executemany( 'UPDATE mails SET password=? WHERE address=? AND target_id ISNULL AND password ISNULL', passwds )
+    return db.total_changes - before
+
+
+def _password_column( db, options ) :
+    """Password hashes of the mailboxes, filled from the passwd file.
+    Fails rather than leaving the mailboxes without their passwords"""
+
+    db.execute( 'ALTER TABLE mails ADD COLUMN password text' )
+    if options.get( 'passwd_file_path' ) is None :
+        raise ValueError( 'The passwd file is needed to import the passwords' )
+    import_passwd_file( db, options['passwd_file_path'] )
+
+
+def _changes_journal( db, options ) :
+    """Journal of the changes of the mails, filled by triggers"""
+
+    changes.create_tables( db )
+
+
+# ( version, description, function applying it to a connection )
+MIGRATIONS = [
+    ( 1, 'Users and mails tables', _baseline ),
+    ( 2, 'Indexes on mails target_id and end_date', _mails_indexes ),
+    ( 3, 'Aliases deleted with their mailbox', _mails_foreign_key ),
+    ( 4, 'End dates as UTC timestamps', _end_date_timestamps ),
+    ( 5, 'Mailboxes passwords', _password_column ),
+    ( 6, 'Changes journal', _changes_journal ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version( db ) :
+    """Return the version of the database schema, 0 if it was never migrated"""
+
+    try :
+        row = db.execute( 'SELECT MAX(version) FROM schema_version' ).fetchone()
+    except sqlite3.OperationalError :
+        # No schema_version table
+        return 0
+    return row[0] or 0
+
+
+def _apply( db, version, description, function, options ) :
+    """Apply one migration in its own transaction.
+    Return False if another process applied it first"""
+
+    db.execute( 'BEGIN IMMEDIATE' )
+    try :
+        # Checked again now that the database is locked
+        if get_version( db ) >= version :
+            db.execute( 'ROLLBACK' )
+            return False
+
+        function( db, options )
+
+        if db.execute( 'PRAGMA foreign_key_check' ).fetchone() is not None :
+            raise sqlite3.IntegrityError( 'Migration '+str( version )+' breaks a foreign key' )
+        db.execute( 'INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                [ version, description, int( time.time() ) ] )
+        db.execute( 'COMMIT' )
+    except :
+        db.execute( 'ROLLBACK' )
+        raise
+    return True
+
+
+def migrate( db, target=None, **options ) :
+    """Apply the missing migrations up to target, the latest one by default.
+    Return the list of the applied versions"""
+
+    if target is None :
+        target = LATEST_VERSION
+
+    # The python module would commit before each DDL statement otherwise
+    isolation_level = db.isolation_level
+    db.commit()
+    db.isolation_level = None
+    # Only changes outside of a transaction, enforced again below
+    db.execute( 'PRAGMA foreign_keys=OFF' )
+    applied = []
+    try :
+        db.execute( VERSION_SCHEMA )
+        for version, description, function in MIGRATIONS :
+            if get_version( db ) < version <= target :
+                if _apply( db, version, description, function, options ) :
+                    applied.append( version )
+    finally :
+        db.execute( 'PRAGMA foreign_keys=ON' )
+        db.isolation_level = isolation_level
+    return applied
+
+
+def reset( db ) :
+    """Drop every SparrowMail table, all of them or none"""
+
+    isolation_level = db.isolation_level
+    db.commit()
+    db.isolation_level = None
+    # Dropping mails would delete its rows one by one otherwise, firing its triggers
+    db.execute( 'PRAGMA foreign_keys=OFF' )
+    try :
+        db.execute( 'BEGIN IMMEDIATE' )
+        try :
+            # mails first, its triggers write in mails_search and changes
+            for table in ( 'mails', 'mails_search', 'users', 'changes', 'change_cursors', 'schema_version' ) :
+                db.execute( 'DROP TABLE IF EXISTS '+table )
+            db.execute( 'COMMIT' )
+        except :
+            db.execute( 'ROLLBACK' )
+            raise
+    finally :
+        db.execute( 'PRAGMA foreign_keys=ON' )
+        db.isolation_level = isolation_level
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+"""Replication of the mail server files to other nodes
+
+The node running SparrowMail keeps a journal of the published files :
+    blobs/<sha256>          content of each version of a file
+    versions/<version>.json manifest of each version
+    nodes/<node>.json       last report of each replica
+    HEAD                    latest version
+A manifest lists every replicated file by name with its checksum, mode and
+mtime, the names changed since the previous version and a checksum of the
+whole set. Names are relative paths whose first part is the kind of file
+('postfix', 'dovecot' or 'vmail').
+
+Agents on the other nodes pull the delta since the version they applied,
+check every blob against its checksum, stage all the files next to their
+targets, then rename them and report the version they applied. Files
+modified on a node are found by their checksum and put back.
+"""
+
+import os
+import json
+import time
+import urllib
+import urllib2
+from hashlib import sha256
+
+from sparrowmail.scripts import publish
+from sparrowmail.scripts.lock import locked, LockTimeout
+
+
+class ReplicationError( Exception ) :
+    """A delta could not be recorded, fetched or applied"""
+    pass
+
+
+def checksum( files ) :
+    """Return the checksum of a set of files given as { name : sha256 }"""
+
+    h = sha256()
+    for name in sorted( files ) :
+        h.update( ( name+' '+files[name]+'\n' ).encode( 'utf-8' ) )
+    return h.hexdigest()
+
+
+def check_name( name ) :
+    """Raise ReplicationError if a file name could escape its target directory"""
+
+    parts = name.split( '/' )
+    if not name or name.startswith( '/' ) or '..' in parts or '' in parts or len( parts ) < 2 :
+        raise ReplicationError( 'Invalid file name '+repr( name ) )
+
+
+def _read_json( path ) :
+    with open( path, 'rb' ) as f :
+        return json.load( f )
+
+
+def _write_json( path, data ) :
+    publish.install_data( path, json.dumps( data, sort_keys=True ) )
+
+
+class Journal :
+    """Versioned and checksummed history of the published files.
+    Only the last history versions are kept, older agents get everything again"""
+
+    def __init__( self, directory, history=100 ) :
+        self.directory = directory
+        self.history = history
+
+    def _path( self, *parts ) :
+        return os.path.join( self.directory, *parts )
+
+    def _makedirs( self ) :
+        for name in ( 'blobs', 'versions', 'nodes' ) :
+            if not os.path.isdir( self._path( name ) ) :
+                os.makedirs( self._path( name ) )
+
+    def head( self ) :
+        """Return the latest version, 0 if nothing was recorded"""
+
+        try :
+            with open( self._path( 'HEAD' ), 'rb' ) as f :
+                return int( f.read().strip() or 0 )
+        except IOError :
+            return 0
+
+    def manifest( self, version ) :
+        """Return the manifest of a version, None if it is not kept"""
+
+        if version == 0 :
+            return { 'version' : 0, 'files' : {}, 'changed' : [], 'checksum' : checksum( {} ) }
+        try :
+            return _read_json( self._path( 'versions', str( version )+'.json' ) )
+        except IOError :
+            return None
+
+    def blob( self, sha ) :
+        """Return the content of a blob. Raise ReplicationError if it is unknown"""
+
+        if len( sha ) != 64 or not all( c in '0123456789abcdef' for c in sha ) :
+            raise ReplicationError( 'Invalid blob '+repr( sha ) )
+        try :
+            with open( self._path( 'blobs', sha ), 'rb' ) as f :
+                return f.read()
+        except IOError :
+            raise ReplicationError( 'Unknown blob '+sha )
+
+    def record( self, files, built_from=None ) :
+        """Record a new version with the current content of files, a dict
+        associating each name with its local path. Missing paths are removed
+        from the replicated set. built_from gives the path of the file each
+        derived file is built from, whose lock guards both.
+        Return the new version, or the latest one if nothing changed"""
+
+        built_from = built_from or {}
+
+        for name in files :
+            check_name( name )
+
+        self._makedirs()
+        with locked( self._path( 'HEAD' ) ) :
+            version = self.head()
+            previous = self.manifest( version )
+            if previous is None :
+                raise ReplicationError( 'The manifest of version '+str( version )+' is missing' )
+            entries = dict( previous['files'] )
+
+            changed = []
+            for name, path in sorted( files.items() ) :
+                # The publisher of the file must not replace it while it is read
+                with locked( built_from.get( name, path ) ) :
+                    try :
+                        with open( path, 'rb' ) as f :
+                            data = f.read()
+                        st = os.stat( path )
+                    except ( IOError, OSError ) :
+                        data = None
+
+                if data is None :
+                    if name in entries :
+                        del entries[name]
+                        changed.append( name )
+                    continue
+
+                sha = sha256( data ).hexdigest()
+                entry = { 'sha256' : sha, 'size' : len( data ),
+                        'mode' : st.st_mode & 0o777, 'mtime' : int( st.st_mtime ) }
+                if entries.get( name ) == entry :
+                    continue
+                if not os.path.exists( self._path( 'blobs', sha ) ) :
+                    publish.install_data( self._path( 'blobs', sha ), data, 0o644 )
+                entries[name] = entry
+                changed.append( name )
+
+            if not changed :
+                return version
+
+            version += 1
+            _write_json( self._path( 'versions', str( version )+'.json' ), {
+                'version' : version,
+                'created' : int( time.time() ),
+                'files' : entries,
+                'changed' : changed,
+                'checksum' : checksum( dict( ( name, e['sha256'] ) for name, e in entries.items() ) ),
+            } )
+            # The manifest is complete before anybody sees it
+            publish.install_data( self._path( 'HEAD' ), str( version )+'\n' )
+            self._prune( version )
+
+        return version
+
+    def _prune( self, version ) :
+        """Delete the manifests older than history and the blobs they alone used.
+        Must be called with the lock of HEAD held"""
+
+        oldest = version - self.history
+        if oldest < 1 :
+            return
+        for filename in os.listdir( self._path( 'versions' ) ) :
+            if filename.endswith( '.json' ) and int( filename[:-len( '.json' )] ) <= oldest :
+                os.remove( self._path( 'versions', filename ) )
+
+        used = set()
+        for v in range( oldest + 1, version + 1 ) :
+            manifest = self.manifest( v )
+            if manifest is not None :
+                used.update( e['sha256'] for e in manifest['files'].values() )
+        for sha in os.listdir( self._path( 'blobs' ) ) :
+            if sha not in used and not sha.startswith( '.' ) :
+                os.remove( self._path( 'blobs', sha ) )
+
+    def delta( self, since ) :
+        """Return what changed after version since :
+            version     the latest version
+            full        True if files is the whole set, since being too old or unknown
+            files       { name : entry } of the files changed since
+            removed     names removed since, empty when full
+            checksum    checksum of the whole set at version"""
+
+        version = self.head()
+        head = self.manifest( version )
+        if head is None :
+            raise ReplicationError( 'The manifest of version '+str( version )+' is missing' )
+
+        names = set()
+        full = since <= 0 or since > version
+        if not full :
+            for v in range( since + 1, version + 1 ) :
+                manifest = self.manifest( v )
+                if manifest is None :
+                    full = True
+                    break
+                names.update( manifest['changed'] )
+
+        if full :
+            files = head['files']
+            removed = []
+        else :
+            files = dict( ( name, head['files'][name] ) for name in names if name in head['files'] )
+            removed = sorted( name for name in names if name not in head['files'] )
+
+        return { 'version' : version, 'full' : full, 'files' : files,
+                'removed' : removed, 'checksum' : head['checksum'] }
+
+    def report( self, node, version, error=None ) :
+        """Save the version a node applied and its last error"""
+
+        check_name( 'nodes/'+node )
+        self._makedirs()
+        _write_json( self._path( 'nodes', node+'.json' ), { 'node' : node,
+            'version' : version, 'error' : error, 'time' : int( time.time() ) } )
+
+    def status( self ) :
+        """Return a dict describing the journal and the replicas"""
+
+        nodes = []
+        if os.path.isdir( self._path( 'nodes' ) ) :
+            for filename in sorted( os.listdir( self._path( 'nodes' ) ) ) :
+                if filename.endswith( '.json' ) :
+                    nodes.append( _read_json( self._path( 'nodes', filename ) ) )
+        return { 'version' : self.head(), 'nodes' : nodes }
+
+
+class JournalSource :
+    """Source of an agent reading a journal directly, on the same host or a shared one"""
+
+    def __init__( self, journal ) :
+        self.journal = journal
+
+    def delta( self, since ) :
+        return self.journal.delta( since )
+
+    def blob( self, sha ) :
+        return self.journal.blob( sha )
+
+    def report( self, node, version, error=None ) :
+        self.journal.report( node, version, error )
+
+
+class HttpSource :
+    """Source of an agent pulling from the /replication/ pages of SparrowMail"""
+
+    def __init__( self, url, token, timeout=30 ) :
+        self.url = url.rstrip( '/' )
+        self.token = token
+        self.timeout = timeout
+
+    def _open( self, path, data=None ) :
+        req = urllib2.Request( self.url+path, data )
+        req.add_header( 'Authorization', 'Bearer '+self.token )
+        if data is not None :
+            req.add_header( 'Content-Type', 'application/json' )
+        try :
+            return urllib2.urlopen( req, timeout=self.timeout ).read()
+        except ( urllib2.URLError, IOError ) as e :
+            raise ReplicationError( self.url+path+' : '+str( e ) )
+
+    def delta( self, since ) :
+        return json.loads( self._open( '/delta?'+urllib.urlencode( { 'since' : since } ) ) )
+
+    def blob( self, sha ) :
+        return self._open( '/blobs/'+sha )
+
+    def report( self, node, version, error=None ) :
+        self._open( '/nodes/'+urllib.quote( node ),
+                json.dumps( { 'version' : version, 'error' : error } ) )
+
+
+class Agent :
+    """Apply the deltas of a source to the files of this node.
+    targets associates each kind of file with the directory its files go in,
+    or is a single directory for all of them. The applied version and files
+    are saved in the state file"""
+
+    def __init__( self, source, targets, state_path, node ) :
+        self.source = source
+        self.targets = targets
+        self.state_path = state_path
+        self.node = node
+
+    def target_path( self, name ) :
+        """Return where the file name goes on this node"""
+
+        check_name( name )
+        kind, rest = name.split( '/', 1 )
+        if isinstance( self.targets, dict ) :
+            if kind not in self.targets :
+                raise ReplicationError( 'No target directory for '+kind )
+            return os.path.join( self.targets[kind], *rest.split( '/' ) )
+        return os.path.join( self.targets, *name.split( '/' ) )
+
+    def state( self ) :
+        """Return the applied version and the { name : entry } of the applied files"""
+
+        try :
+            state = _read_json( self.state_path )
+        except IOError :
+            return { 'version' : 0, 'files' : {} }
+        # Older states only kept the checksum of each file
+        for name, entry in state['files'].items() :
+            if not isinstance( entry, dict ) :
+                state['files'][name] = { 'sha256' : entry }
+        return state
+
+    def _matches( self, name, entry ) :
+        """Tell if the file on this node has the checksum of entry. Size and
+        mtime are not trusted, a file can be changed without them"""
+
+        h = sha256()
+        try :
+            f = open( self.target_path( name ), 'rb' )
+        except IOError :
+            return False
+        with f :
+            for block in iter( lambda : f.read( 65536 ), b'' ) :
+                h.update( block )
+        return h.hexdigest() == entry['sha256']
+
+    def _stage( self, name, entry ) :
+        """Write the new version of a file next to its target. Return the temporary path"""
+
+        data = self.source.blob( entry['sha256'] )
+        if sha256( data ).hexdigest() != entry['sha256'] :
+            raise ReplicationError( 'Checksum mismatch for '+name )
+
+        path = self.target_path( name )
+        if not os.path.isdir( os.path.dirname( path ) ) :
+            os.makedirs( os.path.dirname( path ) )
+        tmp_path = publish.temp_path( path )
+        with open( tmp_path, 'wb' ) as f :
+            f.write( data )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.chmod( tmp_path, entry['mode'] )
+        os.utime( tmp_path, ( entry['mtime'], entry['mtime'] ) )
+        return tmp_path
+
+    def _apply( self, state, delta ) :
+        """Stage every file of the delta, and every file changed on this node,
+        then put them all in place"""
+
+        files = {} if delta['full'] else dict( state['files'] )
+        for name in delta['removed'] :
+            files.pop( name, None )
+        files.update( delta['files'] )
+        if checksum( dict( ( name, e['sha256'] ) for name, e in files.items() ) ) != delta['checksum'] :
+            raise ReplicationError( 'The files of version '+str( delta['version'] )+' don\'t match its checksum' )
+
+        staged = {}
+        try :
+            for name, entry in files.items() :
+                if not self._matches( name, entry ) :
+                    staged[name] = self._stage( name, entry )
+
+            # Files built from another one come after it in the reverse order
+            # ('aliases.db' before 'aliases'), like publish.install does
+            for name in sorted( staged, reverse=True ) :
+                os.rename( staged.pop( name ), self.target_path( name ) )
+        finally :
+            for tmp_path in staged.values() :
+                if os.path.exists( tmp_path ) :
+                    os.remove( tmp_path )
+
+        for name in state['files'] :
+            if name not in files and os.path.exists( self.target_path( name ) ) :
+                os.remove( self.target_path( name ) )
+
+        _write_json( self.state_path, { 'version' : delta['version'], 'files' : files } )
+
+    def _damaged( self, state ) :
+        """Return the names of the applied files modified or removed on this node"""
+
+        return [ name for name, entry in state['files'].items() if not self._matches( name, entry ) ]
+
+    def run_once( self ) :
+        """Pull and apply the delta since the applied version, then report it.
+        Return (True, applied version) or (False, error)"""
+
+        if not os.path.isdir( os.path.dirname( os.path.abspath( self.state_path ) ) ) :
+            os.makedirs( os.path.dirname( os.path.abspath( self.state_path ) ) )
+
+        state = self.state()
+        try :
+            with locked( self.state_path ) :
+                # Another agent of this node may have applied something meanwhile
+                state = self.state()
+                delta = self.source.delta( state['version'] )
+                if delta['version'] == state['version'] and self._damaged( state ) :
+                    # Files changed on this node are put back from the whole set
+                    self._apply( state, self.source.delta( 0 ) )
+                    state = self.state()
+                elif delta['version'] != state['version'] :
+                    try :
+                        self._apply( state, delta )
+                    except ReplicationError :
+                        if delta['full'] :
+                            raise
+                        # The files of this node diverged, take everything again
+                        self._apply( state, self.source.delta( 0 ) )
+                    state = self.state()
+        except ( ReplicationError, LockTimeout, IOError, OSError ) as e :
+            try :
+                self.source.report( self.node, state['version'], str( e ) )
+            except ReplicationError :
+                pass
+            return (False, str( e ))
+
+        try :
+            self.source.report( self.node, state['version'] )
+        except ReplicationError as e :
+            return (False, str( e ))
+        return (True, state['version'])
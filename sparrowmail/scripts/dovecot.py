@@ -1,98 +1,112 @@
 # -*- coding: utf-8 -*-
 
+import os
+import hmac
+import base64
+import hashlib
 import subprocess
+import services
+import publish
 
-def add_passwd( passwd_file_path, address, pw ) :
-    """Add a mail_address:hased_password line into the password file"""
-
-    with open( passwd_file_path, 'a' ) as f :
-        # Hash the password and write it in file
-        hashed_passwd = subprocess.check_output(['doveadm', 'pw', '-s', 'SSHA512', '-p', pw])
-        f.write(address+':'+hashed_passwd)
-
-    return reload_dovecot()
-
-
-def check_passwd( passwd_file_path, address, pw ) :
-    """Check if the given password match the existing one"""
-
-    with open( passwd_file_path, 'r') as f :
-        lines = f.readlines()
-
-    # Search for the line about this address
-    for line in lines :
-        # Is it the right line ?
-        if line.startswith(address) :
-            # Get the hashed password
-            hashed_passwd = line.split(':')[-1]
-            # And check if it matches the given password
-            try :
-                output = subprocess.check_output(
-                        ['doveadm', 'pw', '-p', pw, '-t', hashed_passwd])
-            except subprocess.CalledProcessError :
-                # If the doveadm test failed
-                return False
-            else :
-                # If the doveadm test succeded
-                return True
-    
-    # Address not found in the passwd file
-    return False
-
-def change_passwd( passwd_file_path, address, pw ) :
-    """Change the password associated with the given address. Don't create new entry if don't exists"""
-
-    with open( passwd_file_path, 'r') as f :
-        lines = f.readlines()
-
-    # Search for the line about this address
-    for i in range(len(lines)) :
-        # Is it the right line ?
-        if lines[i].startswith(address) :
-            # Hash the password and write it
-            hashed_passwd = subprocess.check_output(['doveadm', 'pw', '-s', 'SSHA512', '-p', pw])
-            lines[i] = address+':'+hashed_passwd+'\n'
-            break
-    
-    with open( passwd_file_path, 'w') as f :
-        f.writelines( lines )
-
-    return reload_dovecot()
-
-def remove_unexisting( passwd_file_path, mailboxes ) :
-    """Remove any address of the passwd file that is not in given list of mailboxes.
-    Usefull for removing delete mailboxes"""
-
-    with open( passwd_file_path, 'r') as f :
-        lines = f.readlines()
-
-    to_del = []
-
-    # Search fo the line about this address
-    for i in range(len(lines)) :
-        # Is it the right line ?
-        if not lines[i].split(':')[0] in mailboxes:
-            # Save the position and go to deletion of the line
-            to_del.append(i)
-
-    # If the line was found remove this line
-    for i in to_del:
-        lines[i:i+1] = []
-
-    # Write it in the file
-    with open( passwd_file_path, 'w') as f :
-        f.writelines( lines )
-
-    return reload_dovecot()
+# Scheme used for new passwords, in dovecot conf : passdb { args = scheme=<scheme> }
+DEFAULT_SCHEME = 'SSHA512'
+# Size of the salt doveadm uses for {SSHA512} passwords
+SSHA512_SALT_LENGTH = 4
 
+# Set when the passwd file could not be published
+# It is published from all the mailboxes until it succeeds
+_sync_needed = False
 
-def reload_dovecot() :
-    """"Start a subprocess to reload dovecot and take the new configuration into account"""
+
+def get_scheme( hashed_passwd ) :
+    """Return the scheme of a {SCHEME}hash password, None if there is none"""
+
+    if hashed_passwd.startswith( '{' ) and '}' in hashed_passwd :
+        return hashed_passwd[1:hashed_passwd.index( '}' )].upper()
+    return None
+
+def hash_ssha512( pw, salt=None ) :
+    """Hash the password exactly as `doveadm pw -s SSHA512` does"""
+
+    if salt is None :
+        salt = os.urandom( SSHA512_SALT_LENGTH )
+    digest = hashlib.sha512( pw.encode( 'utf-8' ) + salt ).digest()
+    return '{SSHA512}' + base64.b64encode( digest + salt )
+
+def verify_ssha512( pw, hashed_passwd ) :
+    """Check a password against a {SSHA512} hash"""
 
     try :
-        subprocess.check_output(
-                ['sudo', '/etc/init.d/dovecot', 'reload'] )
-    except subprocess.CalledProcessError as e :
-        return (False, e.output)
+        raw = base64.b64decode( hashed_passwd[len( '{SSHA512}' ):] )
+    except TypeError :
+        # Not valid base64
+        return False
+    # The salt is whatever follows the sha512 digest
+    digest, salt = raw[:hashlib.sha512().digest_size], raw[hashlib.sha512().digest_size:]
+    if not salt :
+        return False
+    return hmac.compare_digest( hashlib.sha512( pw.encode( 'utf-8' ) + salt ).digest(), digest )
+
+def doveadm_hash_passwd( pw, scheme ) :
+    """Hash the password with doveadm"""
+
+    return subprocess.check_output(['doveadm', 'pw', '-s', scheme, '-p', pw]).strip()
+
+def doveadm_verify_passwd( pw, hashed_passwd ) :
+    """Check the password against the hash with doveadm"""
+
+    try :
+        subprocess.check_output(['doveadm', 'pw', '-p', pw, '-t', hashed_passwd])
+    except subprocess.CalledProcessError :
+        # If the doveadm test failed
+        return False
     else :
-        return (True, None)
+        # If the doveadm test succeded
+        return True
+
+def hash_passwd( pw, scheme=DEFAULT_SCHEME ) :
+    """Return the {SCHEME}hash of the password.
+    Only unknown schemes are delegated to doveadm"""
+
+    if scheme.upper() == 'SSHA512' :
+        return hash_ssha512( pw )
+    return doveadm_hash_passwd( pw, scheme )
+
+def verify_passwd( pw, hashed_passwd ) :
+    """Check if the password matches the {SCHEME}hash given.
+    Only unknown schemes are delegated to doveadm"""
+
+    if get_scheme( hashed_passwd ) == 'SSHA512' :
+        return verify_ssha512( pw, hashed_passwd )
+    return doveadm_verify_passwd( pw, hashed_passwd )
+
+def sync_needed() :
+    """Tell if the last publication of the passwd file failed"""
+
+    return _sync_needed
+
+def sync_passwd( passwd_file_path, passwds ) :
+    """Publish the passwd file with a line for each (address, hashed password)
+    if they differ from the published ones.
+    Return (True, (added, removed)) with the changed lines or (False, error)"""
+    global _sync_needed
+
+    _sync_needed = True
+    result = publish.sync_entries( passwd_file_path,
+            [ address+':'+hashed_passwd for address, hashed_passwd in passwds ] )
+    if not result[0] :
+        return result
+
+    added, removed = result[1]
+    if added or removed :
+        res = services.manager.request_for( 'passwd' )
+        if not res[0] :
+            return res
+    _sync_needed = False
+    return result
+
+
+def reload_dovecot() :
+    """"Reload dovecot to take the new configuration into account"""
+
+    return services.manager.request( 'dovecot' )
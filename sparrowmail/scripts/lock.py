@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+
+# Seconds between two tries to take a busy lock, doubled up to POLL_MAX
+POLL_MIN = 0.005
+POLL_MAX = 0.1
+
+
+class LockTimeout( Exception ) :
+    """The lock of a file could not be taken in time"""
+
+    def __init__( self, path, timeout ) :
+        Exception.__init__( self, 'Timed out after '+str( timeout )+'s waiting for the lock of '+path )
+        self.path = path
+        self.timeout = timeout
+
+
+class LockManager :
+    """Exclusive locks on files shared by every process and thread.
+    A separate lock file is used since the locked file itself may be replaced.
+    A thread already holding a lock can take it again.
+    Keeps for each file how often and how long the lock was waited for"""
+
+    def __init__( self, lock_dir=None, timeout=30 ) :
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.configure( lock_dir, timeout )
+
+    def configure( self, lock_dir, timeout ) :
+        """lock_dir is where the lock files are created, None to create them
+        next to the locked files. timeout is the default number of seconds
+        to wait for a lock, None to wait forever"""
+
+        with self.lock :
+            self.lock_dir = lock_dir
+            self.timeout = timeout
+            # path -> counters
+            self.metrics = {}
+
+    def get_lock_path( self, path ) :
+        """Return the lock file used for path"""
+
+        if self.lock_dir is None :
+            return path + '.lock'
+        return os.path.join( self.lock_dir,
+                os.path.abspath( path ).strip( '/' ).replace( '/', '_' ) + '.lock' )
+
+    def _record( self, path, waited, contended, timed_out=False, held=None ) :
+        with self.lock :
+            metrics = self.metrics.setdefault( path, {
+                'acquired' : 0, 'contended' : 0, 'timeouts' : 0,
+                'wait_total' : 0.0, 'wait_max' : 0.0, 'held_total' : 0.0, 'held_max' : 0.0,
+            } )
+            if held is not None :
+                metrics['held_total'] += held
+                metrics['held_max'] = max( metrics['held_max'], held )
+                return
+            if timed_out :
+                metrics['timeouts'] += 1
+            else :
+                metrics['acquired'] += 1
+            if contended :
+                metrics['contended'] += 1
+            metrics['wait_total'] += waited
+            metrics['wait_max'] = max( metrics['wait_max'], waited )
+
+    def _acquire( self, f, path, timeout ) :
+        """Take the lock of the opened lock file, raise LockTimeout if it takes too long"""
+
+        start = time.time()
+        try :
+            fcntl.flock( f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB )
+        except IOError :
+            pass
+        else :
+            self._record( path, 0.0, False )
+            return
+
+        # Busy, poll until it's free or the time is out
+        delay = POLL_MIN
+        while True :
+            waited = time.time() - start
+            if timeout is not None and waited >= timeout :
+                self._record( path, waited, True, timed_out=True )
+                raise LockTimeout( path, timeout )
+            sleep = delay if timeout is None else min( delay, timeout - waited )
+            time.sleep( sleep )
+            delay = min( delay * 2, POLL_MAX )
+            try :
+                fcntl.flock( f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB )
+            except IOError :
+                continue
+            self._record( path, time.time() - start, True )
+            return
+
+    @contextmanager
+    def locked( self, path, timeout=-1 ) :
+        """Hold the lock of path. timeout overrides the default one.
+        Raise LockTimeout if the lock could not be taken in time"""
+
+        if timeout == -1 :
+            timeout = self.timeout
+
+        held = getattr( self.local, 'held', None )
+        if held is None :
+            held = self.local.held = set()
+        if path in held :
+            # Already ours, another lock file descriptor would wait for ourselves
+            yield
+            return
+
+        with open( self.get_lock_path( path ), 'a' ) as f :
+            self._acquire( f, path, timeout )
+            held.add( path )
+            start = time.time()
+            try :
+                yield
+            finally :
+                held.discard( path )
+                fcntl.flock( f.fileno(), fcntl.LOCK_UN )
+                self._record( path, 0.0, False, held=time.time() - start )
+
+    def stats( self ) :
+        """Return the counters of each locked file"""
+
+        with self.lock :
+            return dict( ( path, dict( metrics ) ) for path, metrics in self.metrics.items() )
+
+
+# Shared by every writer of the mail server files
+manager = LockManager()
+
+
+def locked( path, timeout=-1 ) :
+    """Hold the lock of path with the shared manager"""
+
+    return manager.locked( path, timeout )
@@ -1,47 +1,92 @@
 # -*- coding: utf-8 -*-
 
+import os
 import subprocess
+import services
+import publish
+
+# Type of the maps built by postmap, as in postfix conf : <type>:<map file>
+map_type = 'hash'
+# Files postmap makes from a map file for each type
+MAP_SUFFIXES = {
+    'hash' : [ '.db' ],
+    'btree' : [ '.db' ],
+    'cdb' : [ '.cdb' ],
+    'lmdb' : [ '.lmdb' ],
+    'dbm' : [ '.dir', '.pag' ],
+}
+
+# Set when maps were published and postfix was not reloaded since
+# Cleared once the reload succeeded, even a delayed one
+_reload_needed = False
+
+def _reloaded () :
+    global _reload_needed
+    _reload_needed = False
 
 def reload_postfix () :
-    try :
-        subprocess.check_output(['sudo', '/etc/init.d/postfix', 'reload'])
-    except subprocess.CalledProcessError as e :
-        return (False, e.output)
-    else :
-        return (True, None)
+    return services.manager.request( 'postfix' )
 
 def hash_file (file_path) :
+    """Build the map postfix reads from the file.
+    Return (True, suffixes of the files built) or (False, error)"""
+
+    suffixes = MAP_SUFFIXES.get( map_type, [] )
     try :
-        subprocess.check_output(['postmap', file_path])
+        subprocess.check_output(['postmap', map_type+':'+file_path], stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e :
+        for suffix in suffixes :
+            if os.path.exists( file_path+suffix ) :
+                os.remove( file_path+suffix )
         return (False, e.output)
     else :
-        return (True, None)
+        return (True, suffixes)
 
-def update_aliases( aliases_file_path, aliases_list ) :
-    with open( aliases_file_path, 'w' ) as f :
-        for alias in aliases_list :
-            f.write( alias[0]+' '+alias[1]+'\n' )
+def sync_map( map_file_path, entries ) :
+    """Publish the entries in the map file if they differ from the published ones.
+    Return (True, (added, removed)) with the sets of changed entries
+    or (False, error) if the map could not be hashed"""
 
-    return hash_file( aliases_file_path )
+    # postmap runs on the new file before it replaces the live one
+    return publish.sync_entries( map_file_path, entries, derived=hash_file )
 
+def update_aliases( aliases_file_path, aliases_list ) :
+    return sync_map( aliases_file_path,
+            [ alias[0]+' '+alias[1] for alias in aliases_list ] )
 
-def update_mailboxes( mailboxes_file_path, mailboxes_list ) :
-    with open( mailboxes_file_path, 'w' ) as f :
-        for mailbox in mailboxes_list :
-            f.write( mailbox+' '+mailbox+'\n' )
 
-    return hash_file( mailboxes_file_path )
+def update_mailboxes( mailboxes_file_path, mailboxes_list ) :
+    return sync_map( mailboxes_file_path,
+            [ mailbox+' '+mailbox for mailbox in mailboxes_list ] )
 
 
 def update (aliases_file_path, mailboxes_file_path, aliases_list, mailboxes_list) :
-    
+    """Publish both maps and reload postfix only if one of them changed.
+    Return (True, changes) where changes associates 'aliases' and 'mailboxes'
+    with their (added, removed) entries or (False, error)"""
+    global _reload_needed
+
     res = update_aliases (aliases_file_path, aliases_list)
     if not res[0] :
         return res
+    changes = { 'aliases' : res[1] }
 
     res = update_mailboxes (mailboxes_file_path, mailboxes_list)
     if not res [0] :
         return res
+    changes['mailboxes'] = res[1]
+
+    for added, removed in changes.values() :
+        if added or removed :
+            _reload_needed = True
+
+    # Nothing published, postfix is already up to date
+    if not _reload_needed :
+        return (True, changes)
+
+    # A reload already waiting only merges this request
+    res = services.manager.request_for( 'postfix_maps', _reloaded )
+    if not res[0] :
+        return res
 
-    return reload_postfix()
+    return (True, changes)
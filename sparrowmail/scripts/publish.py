@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""Publication of the files read by postfix and dovecot
+
+A file is written in a temporary sibling, synced to disk and renamed over
+the live one, so readers always see a complete version of it. The callers
+hold the lock of the file (lock.locked) so two workers never interleave.
+Files made of one entry per line are only written when their entries
+changed (sync_entries).
+"""
+
+import io
+import os
+import tempfile
+from hashlib import sha256
+from lock import locked, LockTimeout
+
+# Fingerprint of the last published version of each file made of entries,
+# keyed by its path. Values are ( fingerprint, file_stat ) tuples
+_published = {}
+
+
+def _copy_owner( tmp_path, path, mode ) :
+    """Give the temporary file the permissions and owner of the file it replaces"""
+
+    try :
+        st = os.stat( path )
+    except OSError :
+        # New file
+        if mode is not None :
+            os.chmod( tmp_path, mode )
+        return
+
+    os.chmod( tmp_path, st.st_mode & 0o7777 if mode is None else mode )
+    try :
+        os.chown( tmp_path, st.st_uid, st.st_gid )
+    except OSError :
+        # Not allowed to give it away, keep our own
+        pass
+
+
+def _sync_dir( dir_path ) :
+    """Make the renames in a directory durable"""
+
+    fd = os.open( dir_path, os.O_RDONLY )
+    try :
+        os.fsync( fd )
+    except OSError :
+        # Some file systems can't sync directories
+        pass
+    finally :
+        os.close( fd )
+
+
+def temp_path( path ) :
+    """Create an empty temporary file next to path and return its path"""
+
+    fd, tmp_path = tempfile.mkstemp( dir=os.path.dirname( os.path.abspath( path ) ),
+            prefix='.'+os.path.basename( path )+'.' )
+    os.close( fd )
+    return tmp_path
+
+
+def install( path, write, mode=None, mtime=None, derived=None ) :
+    """Publish a new version of the file path. The lock of path must be held.
+    write is called with the temporary file opened in binary mode to fill it.
+    mode sets the permissions, the ones of the replaced file are kept otherwise.
+    mtime sets the modification time.
+    derived is called with the temporary path once it is complete and returns
+    (True, suffixes) for the files it made from it (like postmap does), which
+    are renamed to path+suffix before path itself, or (False, error)"""
+
+    tmp_path = temp_path( path )
+    suffixes = []
+    try :
+        with open( tmp_path, 'wb' ) as f :
+            write( f )
+            f.flush()
+            os.fsync( f.fileno() )
+
+        _copy_owner( tmp_path, path, mode )
+        if mtime is not None :
+            os.utime( tmp_path, ( mtime, mtime ) )
+
+        if derived is not None :
+            result = derived( tmp_path )
+            if not result[0] :
+                return result
+            suffixes = result[1]
+            # Readers of the derived files must never see the old one with the new source
+            for suffix in suffixes :
+                os.rename( tmp_path+suffix, path+suffix )
+
+        os.rename( tmp_path, path )
+    finally :
+        for leftover in [ tmp_path ] + [ tmp_path+suffix for suffix in suffixes ] :
+            if os.path.exists( leftover ) :
+                os.remove( leftover )
+
+    _sync_dir( os.path.dirname( os.path.abspath( path ) ) )
+    return (True, None)
+
+
+def install_data( path, data, mode=None, mtime=None, derived=None ) :
+    """Publish data as the new content of the file path. The lock of path must be held"""
+
+    return install( path, lambda f : f.write( data ), mode, mtime, derived )
+
+
+def _checksum( lines ) :
+    """Return the checksum of the file made of the lines"""
+
+    h = sha256()
+    for line in lines :
+        h.update( line.encode( 'utf-8' ) + b'\n' )
+    return h.hexdigest()
+
+
+def fingerprint( entries ) :
+    """Return a fingerprint of a set of entries, whatever their order is.
+    It is the checksum of the file sync_entries writes with them"""
+
+    return _checksum( sorted( set( entries ) ) )
+
+
+def _file_stat( path ) :
+    """Return what identifies a version of a file or None if it doesn't exist"""
+
+    try :
+        st = os.stat( path )
+    except OSError :
+        return None
+    return ( st.st_ino, st.st_size, st.st_mtime )
+
+
+def read_entries( path ) :
+    """Yield the entries of a published file, one line at a time"""
+
+    try :
+        f = io.open( path, 'r', encoding='utf-8' )
+    except IOError :
+        # Nothing published yet
+        return
+    with f :
+        for line in f :
+            line = line.rstrip( '\n' )
+            if line :
+                yield line
+
+
+def get_fingerprint( path ) :
+    """Return the fingerprint of the entries published in a file.
+    The file is only read again if it has been modified by someone else"""
+
+    stat = _file_stat( path )
+    state = _published.get( path )
+    if state is not None and state[1] == stat :
+        return state[0]
+
+    # Unknown or modified file, checksum its content as sync_entries writes it.
+    # A file written otherwise gets a fingerprint of its own and is written again
+    state = ( _checksum( read_entries( path ) ), stat )
+    _published[path] = state
+    return state[0]
+
+
+def _diff( path, entries ) :
+    """Return the (added, removed) sets of entries between the published file
+    and the sorted entries. Both are read in step, as the file is sorted
+    unless someone else wrote it"""
+
+    added = set()
+    removed = set()
+    new = iter( entries )
+    entry = next( new, None )
+    previous = None
+    for line in read_entries( path ) :
+        if previous is not None and line <= previous :
+            # Not written by sync_entries, compare it as a whole
+            old = set( read_entries( path ) )
+            return ( set( entries ) - old, old - set( entries ) )
+        previous = line
+        while entry is not None and entry < line :
+            added.add( entry )
+            entry = next( new, None )
+        if entry == line :
+            entry = next( new, None )
+        else :
+            removed.add( line )
+    while entry is not None :
+        added.add( entry )
+        entry = next( new, None )
+    return ( added, removed )
+
+
+def sync_entries( path, entries, mode=None, derived=None ) :
+    """Publish the entries, one per line, in the file if they differ from the published ones.
+    Only the fingerprint of the file is kept, the file is compared with the
+    entries line by line.
+    Return (True, (added, removed)) with the sets of changed entries
+    or (False, error) if the file could not be published"""
+
+    # Always written sorted so the next diff reads both in step
+    entries = sorted( set( entries ) )
+    new_fingerprint = _checksum( entries )
+
+    # Another worker may be publishing the same file
+    try :
+        with locked( path ) :
+            # Nothing changed, nothing to write
+            if new_fingerprint == get_fingerprint( path ) :
+                return (True, (set(), set()))
+
+            added, removed = _diff( path, entries )
+
+            def write( f ) :
+                for entry in entries :
+                    f.write( ( entry+u'\n' ).encode( 'utf-8' ) )
+
+            res = install( path, write, mode, derived=derived )
+            if not res[0] :
+                # Nothing was published
+                return res
+
+            _published[path] = ( new_fingerprint, _file_stat( path ) )
+    except LockTimeout as e :
+        return (False, str( e ))
+
+    return (True, (added, removed))
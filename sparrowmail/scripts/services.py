@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import subprocess
+import threading
+import time
+
+# Command reloading each service
+COMMANDS = {
+    'postfix' : ['sudo', '/etc/init.d/postfix', 'reload'],
+    'dovecot' : ['sudo', '/etc/init.d/dovecot', 'reload'],
+}
+
+# Service to reload after each kind of change
+# None when the service notices the change by itself :
+# dovecot reads the passwd-file again when it changes
+# and recompiles sieve scripts newer than their binary
+RELOAD_NEEDED = {
+    'postfix_maps' : 'postfix',
+    'passwd' : None,
+    'sieve' : None,
+}
+
+# Bounds in seconds of the delay before retrying a failed delayed reload
+RETRY_MIN = 1
+RETRY_MAX = 60
+
+
+class ReloadManager :
+    """Merge the reload requests of each service.
+    A reload is delayed by window seconds to merge the requests following it
+    and two reloads of a service are at least min_interval seconds apart.
+    A delayed reload that fails is tried again later until it succeeds"""
+
+    def __init__( self, window=0, min_interval=0 ) :
+        self.window = window
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        # Pending reload of each service
+        self.timers = {}
+        # Functions to call once the pending reload of each service succeeded
+        self.waiting = {}
+        # Delay before retrying the failed reload of each service
+        self.retry_delay = {}
+        # Counters and last reload of each service
+        self.requested = {}
+        self.executed = {}
+        self.failed = {}
+        self.last_reload = {}
+        self.last_error = {}
+        # Changes that didn't need any reload
+        self.skipped = {}
+
+    def configure( self, window, min_interval ) :
+        with self.lock :
+            self.window = window
+            self.min_interval = min_interval
+
+    def _execute( self, service ) :
+        """Actually reload the service"""
+
+        try :
+            # The reason of a failure is printed on stderr
+            subprocess.check_output( COMMANDS[service], stderr=subprocess.STDOUT )
+        except subprocess.CalledProcessError as e :
+            result = (False, e.output)
+        else :
+            result = (True, None)
+
+        with self.lock :
+            self.executed[service] = self.executed.get( service, 0 ) + 1
+            if not result[0] :
+                self.failed[service] = self.failed.get( service, 0 ) + 1
+                self.last_error[service] = result[1]
+        return result
+
+    def _schedule( self, service, delay ) :
+        """Start the timer of a pending reload. The lock must be held"""
+
+        timer = threading.Timer( delay, self._run_pending, [service] )
+        timer.daemon = True
+        self.timers[service] = timer
+        timer.start()
+
+    def _run_pending( self, service ) :
+        with self.lock :
+            self.timers.pop( service, None )
+            waiting = self.waiting.pop( service, [] )
+            self.last_reload[service] = time.time()
+        result = self._execute( service )
+
+        with self.lock :
+            if result[0] :
+                self.retry_delay.pop( service, None )
+            else :
+                # Keep waiting, merged with a reload requested meanwhile
+                self.waiting[service] = waiting + self.waiting.get( service, [] )
+                if service not in self.timers :
+                    delay = self.retry_delay.get( service, RETRY_MIN )
+                    self.retry_delay[service] = min( delay*2, RETRY_MAX )
+                    self._schedule( service, max( delay, self.min_interval ) )
+                return
+
+        for done in waiting :
+            done()
+
+    def request( self, service, done=None ) :
+        """Ask for a reload of the service. done is called once it succeeded.
+        Return its result if it was done right away, (True, None) if it was delayed"""
+
+        with self.lock :
+            self.requested[service] = self.requested.get( service, 0 ) + 1
+
+            # Merged with the reload already waiting
+            if service in self.timers :
+                if done is not None :
+                    self.waiting.setdefault( service, [] ).append( done )
+                return (True, None)
+
+            now = time.time()
+            delay = max( self.window,
+                    self.last_reload.get( service, 0 ) + self.min_interval - now )
+            if delay > 0 :
+                if done is not None :
+                    self.waiting.setdefault( service, [] ).append( done )
+                self._schedule( service, delay )
+                return (True, None)
+
+            self.last_reload[service] = now
+
+        result = self._execute( service )
+        if result[0] and done is not None :
+            done()
+        return result
+
+    def request_for( self, change, done=None ) :
+        """Ask for the reload needed after a kind of change, if any.
+        done is called once the change is taken into account"""
+
+        service = RELOAD_NEEDED[change]
+        if service is None :
+            with self.lock :
+                self.skipped[change] = self.skipped.get( change, 0 ) + 1
+            if done is not None :
+                done()
+            return (True, None)
+        return self.request( service, done )
+
+    def stats( self ) :
+        """Return the counters of each service"""
+
+        with self.lock :
+            return {
+                'services' : dict(
+                    ( service, {
+                        'requested' : self.requested.get( service, 0 ),
+                        'executed' : self.executed.get( service, 0 ),
+                        'failed' : self.failed.get( service, 0 ),
+                        'pending' : service in self.timers,
+                        'retry_delay' : self.retry_delay.get( service ),
+                        'last_reload' : self.last_reload.get( service ),
+                        'last_error' : self.last_error.get( service ),
+                    } ) for service in COMMANDS ),
+                'skipped' : dict( self.skipped ),
+            }
+
+
+# Shared by every script
+manager = ReloadManager()
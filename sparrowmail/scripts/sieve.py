@@ -2,52 +2,178 @@
 
 import subprocess
 import os
-import string
-import random
-import dovecot
-
-
-def get_filter_list( mail_dir_path, sieve_filename, exclude_dirname=[] ) :
-    """Return a dict where each key is a mailbox associated with the sieve files
-    mail_dir_path is the path where vmail starts
-    sieve_filename is the base name of the sieve file we're looking for
-    exclude_dirnames is a list of directories to exclude for search"""
-
-    res = {}
-
-    entries_lvl1 = os.listdir( mail_dir_path )
-
-    # for each directory (=domain) in the vmail dir
-    for domain in entries_lvl1 :
-        # Get absolute path
-        abspath_lvl2 = os.path.join( mail_dir_path, domain )
-
-        # Exclude files
-        if os.path.isfile( abspath_lvl2 ) :
+import time
+import shutil
+import atexit
+import tempfile
+import threading
+import json
+import services
+import publish
+from lock import locked, LockTimeout
+from hashlib import sha256
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try :
+    from os import scandir
+except ImportError :
+    # Python 2 needs the scandir package
+    from scandir import scandir
+
+
+def _scan_domain( domain_path, sieve_filename, exclude_dirname ) :
+    """Return a dict associating each user directory of a domain directory
+    with the existence of its sieve file"""
+
+    users = {}
+    # The entries type comes with the listing, no need to stat them
+    for entry in scandir( domain_path ) :
+        # Exclude files and dir that are not actual users
+        if not entry.is_dir() or entry.name in exclude_dirname :
             continue
-        # Exclude dir that are not actual domains or that are files
-        if domain in exclude_dirname :
-            continue
-        
-        entries_lvl2 = os.listdir( abspath_lvl2 )
-
-        # For each directory (=user) in this domain
-        for user in entries_lvl2 :
-            # Get absolute path
-            abspath_lvl3 = os.path.join( abspath_lvl2, user )
-
-            # Exclude files
-            if os.path.isfile( abspath_lvl3 ) :
-                continue
-            # Exclude dir that are not actual users
-            if user in exclude_dirname :
-                continue
-
-            # Add this to res variable even if it doesn't exists
-            res[user+'@'+domain] = os.path.join( abspath_lvl3, sieve_filename )
-
-    # And return the results
-    return res
+        users[entry.name] = os.path.exists( os.path.join( entry.path, sieve_filename ) )
+    return users
+
+
+class FilterIndex :
+    """Index of the mailboxes found in the vmail tree and of their sieve files.
+    Only the domains whose directory changed since the last refresh are listed
+    again, in parallel, and the index is saved in index_path if given.
+    The processes sharing index_path read it again when another one saved it,
+    so they see the filters written through each other. Without it each
+    process only knows its own.
+    A filter created outside of SparrowMail for an existing user is only
+    noticed once its domain directory changes"""
+
+    def __init__( self, mail_dir_path, sieve_filename, exclude_dirname=[],
+            index_path=None, workers=4 ) :
+        self.mail_dir_path = mail_dir_path
+        self.sieve_filename = sieve_filename
+        self.exclude_dirname = exclude_dirname
+        self.index_path = index_path
+        self.workers = workers
+        self.lock = threading.Lock()
+        # domain -> { 'mtime' : mtime of its dir, 'users' : { user : filter exists } }
+        self.domains = None
+        # Version of the saved index the domains come from
+        self.index_stat = None
+
+    def _index_stat( self ) :
+        """Return what identifies a version of the saved index, None if there is none"""
+
+        try :
+            st = os.stat( self.index_path )
+        except OSError :
+            return None
+        return ( st.st_ino, st.st_size, st.st_mtime )
+
+    @contextmanager
+    def _shared( self ) :
+        """Hold the lock of the saved index so the changes of another process are never overwritten"""
+
+        if self.index_path is None :
+            yield
+        else :
+            with locked( self.index_path ) :
+                yield
+
+    def _load( self ) :
+        """Read the saved index if there is one"""
+
+        self.domains = {}
+        if self.index_path is None :
+            return
+        self.index_stat = self._index_stat()
+        try :
+            with open( self.index_path, 'r' ) as f :
+                self.domains = json.load( f )
+        except ( IOError, ValueError ) :
+            # Missing or broken, it will be rebuilt
+            pass
+
+    def _save( self ) :
+        """Save the index, never leaving a half written file"""
+
+        if self.index_path is None :
+            return
+        _install_file( self.index_path, json.dumps( self.domains ).encode( 'utf-8' ) )
+        self.index_stat = self._index_stat()
+
+    def _sync( self ) :
+        """Read the saved index again if another process saved it since.
+        Must be called with the lock and the shared lock held"""
+
+        if self.domains is None or ( self.index_path is not None
+                and self._index_stat() != self.index_stat ) :
+            self._load()
+
+    def refresh( self ) :
+        """List again the domains whose directory changed.
+        Must be called with the lock and the shared lock held"""
+
+        self._sync()
+
+        # The mtime of a domain dir changes when users are added or removed
+        current = {}
+        for entry in scandir( self.mail_dir_path ) :
+            if entry.is_dir() and entry.name not in self.exclude_dirname :
+                current[entry.name] = ( entry.path, entry.stat().st_mtime )
+
+        changed = [ domain for domain, ( path, mtime ) in current.items()
+                if domain not in self.domains or self.domains[domain]['mtime'] != mtime ]
+        removed = [ domain for domain in self.domains if domain not in current ]
+
+        if changed :
+            pool = ThreadPool( min( self.workers, len( changed ) ) )
+            try :
+                scans = pool.map( lambda domain : _scan_domain( current[domain][0],
+                        self.sieve_filename, self.exclude_dirname ), changed )
+            finally :
+                pool.close()
+            for domain, users in zip( changed, scans ) :
+                self.domains[domain] = { 'mtime' : current[domain][1], 'users' : users }
+        for domain in removed :
+            del self.domains[domain]
+
+        if changed or removed :
+            self._save()
+
+    def get( self ) :
+        """Return a dict associating each mailbox with the path of its sieve file
+        and whether this file exists"""
+
+        with self.lock :
+            try :
+                with self._shared() :
+                    self.refresh()
+            except LockTimeout :
+                # Another process is saving it, show what this one knows
+                if self.domains is None :
+                    raise
+            res = {}
+            for domain, info in self.domains.items() :
+                for user, exists in info['users'].items() :
+                    res[user+'@'+domain] = ( os.path.join( self.mail_dir_path,
+                        domain, user, self.sieve_filename ), exists )
+            return res
+
+    def set_exists( self, mailbox, exists=True ) :
+        """Record a filter written or removed by SparrowMail"""
+
+        user, domain = mailbox.split( '@' )
+        with self.lock :
+            try :
+                with self._shared() :
+                    self._sync()
+                    if domain in self.domains :
+                        self.domains[domain]['users'][user] = exists
+                        self._save()
+            except LockTimeout :
+                # Seen by this process only
+                if self.domains is not None and domain in self.domains :
+                    self.domains[domain]['users'][user] = exists
 
 
 def get_filter_filepath_from_mailbox( mail_dir_path, mailbox, sieve_filename ) :
@@ -83,20 +209,45 @@ def get_filter_content_from_mailbox( mail_dir_path, mailbox, sieve_filename ) :
     return get_filter_content_from_filepath( filepath )
 
 
+def get_binary_filepath( filepath ) :
+    """Return the path of the compiled binary of a sieve file, as dovecot expects it"""
+
+    if filepath.endswith( '.sieve' ) :
+        filepath = filepath[:-len( '.sieve' )]
+    return filepath + '.svbin'
+
+
+def _install_file( filepath, data, mtime=None ) :
+    """Replace filepath with data so the file is never seen half written.
+    Set its modification time if given"""
+
+    publish.install_data( filepath, data, 0o644, mtime )
+
+
 def set_filter_from_filepath( filepath, content ) :
-    """Write data inside the sieve file given"""
+    """Write data inside the sieve file given
+    and install its compiled binary so it's not compiled on the next delivery"""
 
     # Check for the dir to exists
     dir_path = os.path.dirname( filepath )
     if not os.path.exists( dir_path ) :
         os.makedirs( dir_path )
 
-    # Open the file and create it if it doesn't exists
-    with open( filepath, 'w+' ) as f :
-        # Write the actual content
-        f.write( content )
+    # Both files get the same whole second mtime so dovecot sees the binary up to date
+    mtime = int( time.time() )
+
+    # The script and its binary must come from the same worker
+    try :
+        with locked( filepath ) :
+            # Write the actual content
+            _install_file( filepath, content.encode( 'utf-8' ), mtime )
 
-    return dovecot.reload_dovecot()
+            # Compiled from its final path, which dovecot finds in the binary
+            compiler.install_binary( filepath, mtime )
+    except LockTimeout as e :
+        return (False, str( e ))
+
+    return services.manager.request_for( 'sieve' )
 
 
 def set_filter_from_mailbox( mail_dir_path, mailbox, sieve_filename, content ) :
@@ -109,30 +260,124 @@ def set_filter_from_mailbox( mail_dir_path, mailbox, sieve_filename, content ) :
 
 
 
-def check_filter_content( content ) :
-    """Write the content to a temporary file and check if it can compile it
-    If there are errors return it in second element of the returned tuple"""
-    
-    # Get a random file in /tmp
-    characters = string.ascii_letters + string.digits
-    filename = ''.join([random.choice( characters ) for n in range( 10 )])
-    dir_path = '/tmp/sparrowmail/'
-    if not os.path.exists( dir_path ) :
-        os.makedirs( dir_path )
-    sievefile_path = dir_path + filename + '.sieve'
-    svbinfile_path = dir_path + filename + '.svbin'
-
-    with open( sievefile_path, 'w+' ) as f :
-        # Write the data in tmp file
-        f.write( content )
-
-    # Try to compile
-    try :
-        subprocess.check_output(['sievec', '-d', sievefile_path, svbinfile_path], stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        return (False, '\n'.join(e.output.replace( filename+':', "" ).split( '\n' )[:-2]))
-    else :
-        return (True, None)
+class SieveCompiler :
+    """Check and compile sieve scripts with sievec.
+    At most workers sievec run at the same time. Checks run in a private
+    scratch directory removed at exit, and their results are remembered by
+    hash of the script"""
+
+    def __init__( self, workers=2, cache_size=256 ) :
+        self.lock = threading.Lock()
+        self.scratch_dir = None
+        self.configure( workers, cache_size )
+
+    def configure( self, workers, cache_size ) :
+        with self.lock :
+            self.slots = threading.BoundedSemaphore( workers )
+            self.cache_size = cache_size
+            self.cache = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def _get_scratch_dir( self ) :
+        """Return the private directory where scripts are compiled"""
+
+        with self.lock :
+            if self.scratch_dir is None or not os.path.isdir( self.scratch_dir ) :
+                self.scratch_dir = tempfile.mkdtemp( prefix='sparrowmail-sieve-' )
+                atexit.register( shutil.rmtree, self.scratch_dir, True )
+            return self.scratch_dir
+
+    def _compile( self, content ) :
+        """Run sievec on the script and clean up after it.
+        Return (True, None) if it compiled or (False, errors)"""
+
+        fd, sievefile_path = tempfile.mkstemp( suffix='.sieve', dir=self._get_scratch_dir() )
+        # sievec names the script after the file without its extension
+        scriptname = os.path.basename( sievefile_path )[:-len( '.sieve' )]
+        svbinfile_path = get_binary_filepath( sievefile_path )
+
+        try :
+            with os.fdopen( fd, 'wb' ) as f :
+                # Write the data in tmp file
+                f.write( content.encode( 'utf-8' ) )
+
+            # Try to compile
+            try :
+                subprocess.check_output(['sievec', sievefile_path, svbinfile_path], stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                return (False, '\n'.join(e.output.replace( scriptname+':', "" ).split( '\n' )[:-2]))
+            else :
+                return (True, None)
+        finally :
+            for path in ( sievefile_path, svbinfile_path ) :
+                if os.path.exists( path ) :
+                    os.remove( path )
+
+    def check( self, content ) :
+        """Return (True, None) if the script compiles or (False, errors),
+        from the cache when it was already checked"""
+
+        key = sha256( content.encode( 'utf-8' ) ).hexdigest()
+
+        with self.lock :
+            entry = self.cache.pop( key, None )
+            if entry is not None :
+                # Put it back as the most recently used
+                self.cache[key] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        with self.slots :
+            entry = self._compile( content )
+
+        with self.lock :
+            self.cache[key] = entry
+            while len( self.cache ) > self.cache_size :
+                self.cache.popitem( last=False )
+
+        return entry
+
+    def install_binary( self, sievefile_path, mtime ) :
+        """Compile an installed script into a temporary file next to its
+        binary and rename it over the binary, with the modification time mtime.
+        The binary records the path of its script, so it must be this one.
+        Return True if it compiled"""
+
+        svbinfile_path = get_binary_filepath( sievefile_path )
+        fd, tmp_path = tempfile.mkstemp( suffix='.svbin', dir=os.path.dirname( svbinfile_path ),
+                prefix='.'+os.path.basename( svbinfile_path )+'.' )
+        os.close( fd )
+        try :
+            with self.slots :
+                try :
+                    subprocess.check_output(['sievec', sievefile_path, tmp_path], stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError :
+                    # The old binary may look as recent as the script, dovecot
+                    # compiles it on delivery and reports the errors
+                    if os.path.exists( svbinfile_path ) :
+                        os.remove( svbinfile_path )
+                    return False
+            os.chmod( tmp_path, 0o644 )
+            os.utime( tmp_path, ( mtime, mtime ) )
+            os.rename( tmp_path, svbinfile_path )
+            return True
+        finally :
+            if os.path.exists( tmp_path ) :
+                os.remove( tmp_path )
+
+    def stats( self ) :
+        with self.lock :
+            return { 'cached' : len( self.cache ), 'hits' : self.hits, 'misses' : self.misses }
+
+
+# Shared by every check
+compiler = SieveCompiler()
 
 
+def check_filter_content( content ) :
+    """Check if the content can be compiled
+    If there are errors return it in second element of the returned tuple"""
 
+    return compiler.check( content )
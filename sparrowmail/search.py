@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Address search backed by an FTS5 trigram index of the mails table
+
+The index is kept up to date by triggers on mails. When SQLite lacks FTS5
+or the trigram tokenizer, searches fall back to a LIKE scan.
+"""
+
+import sqlite3
+
+# The trigram tokenizer only indexes substrings of 3 characters or more
+MIN_INDEXED_LENGTH = 3
+
+# Keep the index up to date, created again when the mails table is rebuilt
+TRIGGERS = [
+"""CREATE TRIGGER IF NOT EXISTS mails_search_insert AFTER INSERT ON mails BEGIN
+    INSERT INTO mails_search (rowid, address) VALUES (new.id, new.address);
+END""",
+
+"""CREATE TRIGGER IF NOT EXISTS mails_search_delete AFTER DELETE ON mails BEGIN
+    INSERT INTO mails_search (mails_search, rowid, address) VALUES ('delete', old.id, old.address);
+END""",
+
+"""CREATE TRIGGER IF NOT EXISTS mails_search_update AFTER UPDATE OF address ON mails BEGIN
+    INSERT INTO mails_search (mails_search, rowid, address) VALUES ('delete', old.id, old.address);
+    INSERT INTO mails_search (rowid, address) VALUES (new.id, new.address);
+END""",
+]
+
+INDEX_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS mails_search
+    USING fts5(address, content='mails', content_rowid='id', tokenize='trigram');
+
+""" + ''.join( trigger + ';\n\n' for trigger in TRIGGERS ) + """\
+INSERT INTO mails_search (mails_search) VALUES ('rebuild');
+"""
+
+
+def create_index( db ) :
+    """Create the search index and fill it with the existing mails.
+    Return False if this SQLite can't provide it"""
+
+    try :
+        db.executescript( INDEX_SCHEMA )
+    except sqlite3.OperationalError :
+        # No FTS5 or no trigram tokenizer
+        db.rollback()
+        return False
+    db.commit()
+    return True
+
+
+def create_triggers( db ) :
+    """Create the triggers of an existing index, without committing"""
+
+    for trigger in TRIGGERS :
+        db.execute( trigger )
+
+
+def has_index( db ) :
+    """Tell if the search index exists in the database"""
+
+    cur = db.execute( "SELECT 1 FROM sqlite_master WHERE name='mails_search'" )
+    return cur.fetchone() is not None
+
+
+def escape_like( pattern ) :
+    """Escape the LIKE wildcards of a user given string"""
+
+    return pattern.replace( '\\', '\\\\' ).replace( '%', '\\%' ).replace( '_', '\\_' )
+
+
+def _contains( indexed, text ) :
+    """Return the condition and arguments selecting the mails whose address contains text"""
+
+    like = ( "m.address LIKE ? ESCAPE '\\'", [ '%'+escape_like( text )+'%' ] )
+    if not indexed or len( text ) < MIN_INDEXED_LENGTH :
+        return like
+
+    # The index gives the candidates, LIKE keeps the exact matches
+    phrase = '"' + text.replace( '"', '""' ) + '"'
+    return ( "m.id IN ( SELECT rowid FROM mails_search WHERE mails_search MATCH ? ) AND " + like[0],
+            [ phrase ] + like[1] )
+
+
+def search_mails( db, text=None, domain=None, expires_before=None, limit=100 ) :
+    """Return the mails matching all the given criterias, ordered by address
+    text is a substring of the address
+    domain is the domain of the address
+    expires_before selects the mails with an end date lower than this timestamp"""
+
+    indexed = has_index( db )
+    conditions = []
+    args = []
+
+    if text :
+        condition, condition_args = _contains( indexed, text )
+        conditions.append( condition )
+        args += condition_args
+    if domain :
+        condition, condition_args = _contains( indexed, '@'+domain )
+        # Only at the end of the address
+        conditions.append( condition + " AND m.address LIKE ? ESCAPE '\\'" )
+        args += condition_args + [ '%@'+escape_like( domain ) ]
+    if expires_before is not None :
+        conditions.append( 'm.end_date < ?' )
+        args.append( expires_before )
+    if not conditions :
+        conditions.append( '1' )
+
+    args.append( limit )
+    cur = db.execute( 'SELECT m.id, m.address, m.end_date, t.address AS target'
+            ' FROM mails AS m LEFT JOIN mails AS t ON t.id=m.target_id'
+            ' WHERE ' + ' AND '.join( conditions ) +
+            ' ORDER BY m.address LIMIT ?', args )
+    return cur.fetchall()
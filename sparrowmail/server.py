@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""Production web server for SparrowMail.
+Gunicorn pre-forks SERVER_WORKERS processes each serving SERVER_THREADS
+requests at the same time. Sending SIGHUP to the master reloads the
+configuration and replaces the workers gracefully.
+Without gunicorn, a single threaded werkzeug server is used"""
+
+import multiprocessing
+from werkzeug.serving import run_simple, WSGIRequestHandler
+
+try :
+    from gunicorn.app.base import BaseApplication
+except ImportError :
+    # Optional dependency, only needed for several workers
+    BaseApplication = None
+
+
+def get_workers( config ) :
+    """Return the number of worker processes to start"""
+
+    workers = config['SERVER_WORKERS']
+    if not workers :
+        # Usual gunicorn advice
+        workers = multiprocessing.cpu_count() * 2 + 1
+    return workers
+
+
+def get_bind( config ) :
+    host = config['SERVER_HOST'] or '127.0.0.1'
+    port = config['SERVER_PORT'] or '5000'
+    return '%s:%s' % ( host, port )
+
+
+if BaseApplication is not None :
+
+    class GunicornServer( BaseApplication ) :
+        """Gunicorn application serving the flask app with the SparrowMail config"""
+
+        def __init__( self, app ) :
+            self.application = app
+            super( GunicornServer, self ).__init__()
+
+        def load_config( self ) :
+            config = self.application.config
+            settings = {
+                'bind' : get_bind( config ),
+                'workers' : get_workers( config ),
+                # Threads only make sense with the gthread worker
+                'worker_class' : 'gthread',
+                'threads' : config['SERVER_THREADS'],
+                'keepalive' : config['SERVER_KEEPALIVE'],
+                'graceful_timeout' : config['SERVER_GRACEFUL_TIMEOUT'],
+                'timeout' : config['SERVER_TIMEOUT'],
+                'proc_name' : 'sparrowmail',
+            }
+            for key, value in settings.items() :
+                self.cfg.set( key, value )
+
+        def load( self ) :
+            return self.application
+
+
+class KeepAliveRequestHandler( WSGIRequestHandler ) :
+    """Keep the connections open between requests, as gunicorn does"""
+
+    protocol_version = 'HTTP/1.1'
+
+
+def run( app ) :
+    """Serve the app until interrupted"""
+
+    # Never expose the debugger to the outside world
+    app.debug = False
+
+    if BaseApplication is None :
+        app.logger.warning( "gunicorn is not installed, "
+                "serving with a single process of werkzeug threads" )
+        host, port = get_bind( app.config ).rsplit( ':', 1 )
+        run_simple( host, int( port ), app, threaded=True,
+                request_handler=KeepAliveRequestHandler )
+    else :
+        GunicornServer( app ).run()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+# Seconds before publishing again after a failure, doubled up to RETRY_MAX
+RETRY_MIN = 1
+RETRY_MAX = 60
+
+class SyncWorker :
+    """Background thread publishing the mail server files once per burst of changes.
+    Changes are published when no new one came for debounce seconds, or at
+    the latest max_latency seconds after the first unpublished one.
+    A failed publication is tried again after an increasing delay.
+    publish is called without argument and must return True on success"""
+
+    def __init__( self, publish, debounce, max_latency ) :
+        self.publish = publish
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.cond = threading.Condition()
+        self.thread = None
+        self.pid = None
+        # Generation of the last change and of the last published change
+        self.generation = 0
+        self.published_generation = 0
+        # Time and result of the last publication
+        self.last_publish = None
+        self.last_result = None
+        # Time of the first and last unpublished changes
+        self.first_dirty = None
+        self.last_dirty = None
+        # Delay and time of the next try after a failure
+        self.retry_delay = RETRY_MIN
+        self.retry_at = None
+
+    def _start( self ) :
+        """Start the thread if it isn't running in this process"""
+
+        # Threads don't survive a fork so check the pid too
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid() :
+            return
+        self.pid = os.getpid()
+        self.thread = threading.Thread( target=self._run, name='sparrowmail-sync' )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def mark_dirty( self ) :
+        """Notify the worker that the files need to be published.
+        Return the generation of this change"""
+
+        with self.cond :
+            now = time.time()
+            self.generation += 1
+            if self.first_dirty is None :
+                self.first_dirty = now
+            self.last_dirty = now
+            self._start()
+            self.cond.notify_all()
+            return self.generation
+
+    def _run( self ) :
+        while True :
+            with self.cond :
+                # Wait for something to publish
+                while self.first_dirty is None :
+                    self.cond.wait()
+
+                # Wait for the end of the burst but not longer than max_latency
+                while True :
+                    deadline = min( self.last_dirty + self.debounce,
+                            self.first_dirty + self.max_latency )
+                    if self.retry_at is not None :
+                        deadline = max( deadline, self.retry_at )
+                    now = time.time()
+                    if now >= deadline :
+                        break
+                    self.cond.wait( deadline - now )
+
+                generation = self.generation
+                self.first_dirty = None
+                self.last_dirty = None
+
+            # Publish outside of the lock so requests are never blocked
+            result = self.publish()
+
+            with self.cond :
+                self.last_result = result
+                if result :
+                    self.published_generation = generation
+                    self.last_publish = time.time()
+                    self.retry_delay = RETRY_MIN
+                    self.retry_at = None
+                else :
+                    # Still dirty, published again once the delay is over
+                    now = time.time()
+                    self.retry_at = now + self.retry_delay
+                    self.retry_delay = min( self.retry_delay * 2, RETRY_MAX )
+                    if self.first_dirty is None :
+                        self.first_dirty = now
+                        self.last_dirty = now
+                self.cond.notify_all()
+
+    def wait( self, generation, timeout=None ) :
+        """Wait until the given generation is published.
+        Return False if the timeout expired before"""
+
+        end = None if timeout is None else time.time() + timeout
+        with self.cond :
+            while self.published_generation < generation :
+                if end is None :
+                    self.cond.wait()
+                else :
+                    now = time.time()
+                    if now >= end :
+                        return False
+                    self.cond.wait( end - now )
+        return True
+
+    def status( self ) :
+        """Return a dict describing the state of the synchronisation"""
+
+        with self.cond :
+            return {
+                'generation' : self.generation,
+                'published_generation' : self.published_generation,
+                'pending' : self.generation != self.published_generation,
+                'last_publish' : self.last_publish,
+                'last_result' : self.last_result,
+                'retry_at' : self.retry_at,
+            }
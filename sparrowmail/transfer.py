@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming import and export of the mails as CSV or JSON lines
+
+Each mail is a row with the fields of FIELDS :
+    address     the mail address
+    mailbox     the mailbox of an alias, empty for a mailbox
+    end_date    YYYY-MM-DD HH:MM:SS UTC, empty if there is none
+    password    the {SCHEME}hash of a mailbox password
+Mailboxes come before aliases so an import can resolve the aliases targets.
+"""
+
+import csv
+import json
+
+from email_validator import validate_email, EmailNotValidError
+
+from sparrowmail import dates
+
+FIELDS = [ 'address', 'mailbox', 'end_date', 'password' ]
+FORMATS = [ 'csv', 'jsonl' ]
+
+
+def read_rows( f, fmt ) :
+    """Yield a dict for each row of the file"""
+
+    if fmt == 'jsonl' :
+        for line in f :
+            if line.strip() :
+                yield json.loads( line )
+    else :
+        for row in csv.DictReader( f ) :
+            yield dict( ( key, value.decode( 'utf-8' ) if value else None )
+                    for key, value in row.items() )
+
+
+def write_rows( f, fmt, rows ) :
+    """Write the rows in the file. Return how many were written"""
+
+    count = 0
+    if fmt == 'jsonl' :
+        for row in rows :
+            f.write( json.dumps( row, sort_keys=True ) + '\n' )
+            count += 1
+    else :
+        writer = csv.DictWriter( f, FIELDS )
+        writer.writeheader()
+        for row in rows :
+            writer.writerow( dict( ( key, value.encode( 'utf-8' ) if value else '' )
+                    for key, value in row.items() ) )
+            count += 1
+    return count
+
+
+def export_rows( db ) :
+    """Yield the rows of all the mails, mailboxes first, without loading them all"""
+
+    cur = db.execute( 'SELECT m.address, t.address AS mailbox, m.end_date, m.password'
+            ' FROM mails AS m LEFT JOIN mails AS t ON t.id=m.target_id'
+            ' ORDER BY m.target_id NOTNULL, m.address' )
+    for row in cur :
+        yield {
+            'address' : row['address'],
+            'mailbox' : row['mailbox'],
+            'end_date' : dates.format_date( row['end_date'] ),
+            'password' : row['password'],
+        }
+
+
+def _check_row( row ) :
+    """Return the normalized (address, mailbox, end_date, password) of a row.
+    Raise ValueError with the reason if it's not valid"""
+
+    try :
+        address = validate_email( row.get( 'address' ) or '', check_deliverability=False )['email']
+        mailbox = None
+        if row.get( 'mailbox' ) :
+            mailbox = validate_email( row['mailbox'], check_deliverability=False )['email']
+    except EmailNotValidError as e :
+        # The reason may quote the address, it's unicode
+        raise ValueError( unicode( e ) )
+
+    end_date = dates.parse_date( row.get( 'end_date' ) )
+
+    password = row.get( 'password' ) or None
+    if password and not password.startswith( '{' ) :
+        raise ValueError( 'The password must be given hashed as {SCHEME}hash' )
+    if mailbox and password :
+        raise ValueError( 'An alias can\'t have a password' )
+
+    return ( address, mailbox, end_date, password )
+
+
+def import_rows( db, rows, chunk_size=500, report=None ) :
+    """Insert the rows in the database by chunks, each in its own transaction.
+    report is called with the row number and the reason, as unicode, of each skipped row.
+    Return the number of imported and skipped rows"""
+
+    imported = 0
+    skipped = 0
+
+    def skip( number, reason ) :
+        if report is not None :
+            report( number, unicode( reason ) )
+
+    chunk = []
+    for number, row in enumerate( rows, 1 ) :
+        try :
+            chunk.append( ( number, _check_row( row ) ) )
+        except ValueError as e :
+            skipped += 1
+            skip( number, unicode( e ) )
+        if len( chunk ) >= chunk_size :
+            done = _import_chunk( db, chunk, skip )
+            imported += done
+            skipped += len( chunk ) - done
+            chunk = []
+    if chunk :
+        done = _import_chunk( db, chunk, skip )
+        imported += done
+        skipped += len( chunk ) - done
+
+    return ( imported, skipped )
+
+
+def _import_chunk( db, chunk, skip ) :
+    """Insert one chunk of checked rows. Return how many were inserted"""
+
+    # Addresses already used are skipped
+    addresses = [ row[0] for number, row in chunk ]
+    cur = db.execute( 'SELECT address FROM mails WHERE address IN (' +
+            ','.join( '?' * len( addresses ) ) + ')', addresses )
+    existing = set( r['address'] for r in cur )
+
+    mailboxes = []
+    aliases = []
+    seen = set()
+    for number, ( address, mailbox, end_date, password ) in chunk :
+        if address in existing or address in seen :
+            skip( number, address+' is already used' )
+        elif mailbox is None :
+            mailboxes.append( ( address, end_date, password ) )
+        else :
+            aliases.append( ( number, address, mailbox, end_date ) )
+        seen.add( address )
+
+    with db :
+        db.executemany( 'INSERT INTO mails (address, end_date, password) VALUES (?, ?, ?)', mailboxes )
+
+        # Resolve the mailboxes of the aliases, including the ones just inserted
+        targets = list( set( mailbox for number, address, mailbox, end_date in aliases ) )
+        cur = db.execute( 'SELECT id, address FROM mails WHERE target_id ISNULL AND address IN (' +
+                ','.join( '?' * len( targets ) ) + ')', targets )
+        target_ids = dict( ( r['address'], r['id'] ) for r in cur )
+
+        resolved = []
+        for number, address, mailbox, end_date in aliases :
+            if mailbox in target_ids :
+                resolved.append( ( address, target_ids[mailbox], end_date ) )
+            else :
+                skip( number, 'The mailbox '+mailbox+' of '+address+' doesn\'t exist' )
+        db.executemany( 'INSERT INTO mails (address, target_id, end_date) VALUES (?, ?, ?)', resolved )
+
+    return len( mailboxes ) + len( resolved )
@@ -3,7 +3,10 @@ from sparrowmail import app
 server_host = app.config['SERVER_HOST']
 server_port = app.config['SERVER_PORT']
 
-if server_host :
+if app.config['SERVER_MODE'] == 'production' :
+    from sparrowmail import server
+    server.run(app)
+elif server_host :
     if server_port :
         app.run(host=server_host, port=server_port)
     else :
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""Bulk API answering with a result per operation
+
+Run with : python -m unittest discover tests
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from sparrowmail import main, migrations
+
+
+class BulkTest( unittest.TestCase ) :
+
+    def setUp( self ) :
+        self.dir = tempfile.mkdtemp()
+        self.config = dict( main.app.config )
+        main.app.config['DATABASE'] = os.path.join( self.dir, 'test.db' )
+        main.app.config['EXPIRY_IN_BACKGROUND'] = False
+        # The test client serves localhost at the root
+        main.app.config['APPLICATION_ROOT'] = '/'
+        main.app.config['SESSION_COOKIE_DOMAIN'] = None
+        main.db_manager.configure( main.app.config['DATABASE'], **main.database_options() )
+        db = main.connect_db()
+        migrations.migrate( db, passwd_file_path=os.path.join( self.dir, 'passwd' ) )
+        db.close()
+
+        self.client = main.app.test_client()
+        with self.client.session_transaction() as session :
+            session['user_id'] = 1
+
+    def tearDown( self ) :
+        main.app.config.update( self.config )
+        main.db_manager.configure( main.app.config['DATABASE'], **main.database_options() )
+        shutil.rmtree( self.dir )
+
+    def test_non_ascii_invalid_address( self ) :
+        operations = [
+            { 'op' : 'add_mailbox', 'address' : u'a@éé☃', 'password' : 'secret' },
+            { 'op' : 'add_alias', 'address' : u'b@éé☃', 'mailbox' : u'é@' },
+            'not an operation',
+        ]
+        response = self.client.post( '/api/bulk', data=json.dumps( { 'operations' : operations } ),
+                content_type='application/json' )
+        self.assertEqual( response.status_code, 400 )
+
+        data = json.loads( response.data )
+        self.assertFalse( data['applied'] )
+        self.assertEqual( len( data['results'] ), 3 )
+        for result in data['results'] :
+            self.assertFalse( result['ok'] )
+        self.assertEqual( data['results'][0]['address'], u'a@éé☃' )
+        self.assertIn( u'a@éé☃ is not a valid email', data['results'][0]['error'] )
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""Passwords hashed like `doveadm pw -s SSHA512`
+
+Run with : python -m unittest discover tests
+"""
+
+import os
+import subprocess
+import unittest
+
+from sparrowmail.scripts import dovecot
+
+# {SSHA512} is base64( sha512( password + salt ) + salt ), here with the salt 8a3c51e2
+KNOWN_PASSWORD = u'sparrow'
+KNOWN_SALT = b'\x8a\x3c\x51\xe2'
+KNOWN_HASH = '{SSHA512}p3yfxGwPz39M1pGHgy8Ph62wEDFTetXDTR3Y7hrjmb+yZedFJkNjUPE2sfi6JemjiQaqeth0hH5jzICly4Il0oo8UeI='
+
+
+def has_doveadm() :
+    return any( os.access( os.path.join( path, 'doveadm' ), os.X_OK )
+            for path in os.environ.get( 'PATH', '' ).split( os.pathsep ) )
+
+
+class SSHA512Test( unittest.TestCase ) :
+
+    def test_known_hash( self ) :
+        self.assertEqual( dovecot.hash_ssha512( KNOWN_PASSWORD, KNOWN_SALT ), KNOWN_HASH )
+        self.assertTrue( dovecot.verify_ssha512( KNOWN_PASSWORD, KNOWN_HASH ) )
+        self.assertFalse( dovecot.verify_ssha512( u'sparrows', KNOWN_HASH ) )
+        self.assertEqual( dovecot.get_scheme( KNOWN_HASH ), 'SSHA512' )
+
+    def test_round_trip( self ) :
+        for pw in ( u'secret', u'pàsswörd ☃', u'' ) :
+            hashed = dovecot.hash_ssha512( pw )
+            self.assertTrue( hashed.startswith( '{SSHA512}' ) )
+            self.assertTrue( dovecot.verify_passwd( pw, hashed ) )
+            self.assertFalse( dovecot.verify_passwd( pw+u'x', hashed ) )
+        # A new salt each time
+        self.assertNotEqual( dovecot.hash_ssha512( u'secret' ), dovecot.hash_ssha512( u'secret' ) )
+
+    def test_malformed_hash( self ) :
+        self.assertFalse( dovecot.verify_ssha512( u'secret', '{SSHA512}not base64!' ) )
+        # A digest without its salt
+        self.assertFalse( dovecot.verify_ssha512( u'secret', KNOWN_HASH[:-8] ) )
+
+    @unittest.skipUnless( has_doveadm(), 'doveadm is not installed' )
+    def test_doveadm( self ) :
+        # doveadm checks our hash and we check its own
+        self.assertTrue( dovecot.doveadm_verify_passwd( KNOWN_PASSWORD, KNOWN_HASH ) )
+        hashed = subprocess.check_output( [ 'doveadm', 'pw', '-s', 'SSHA512', '-p', 'secret' ] ).strip()
+        self.assertTrue( dovecot.verify_ssha512( u'secret', hashed ) )
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""Index of the sieve filters shared by two processes through its saved file
+
+Run with : python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sparrowmail.scripts import sieve
+
+
+class FilterIndexTest( unittest.TestCase ) :
+
+    def setUp( self ) :
+        self.dir = tempfile.mkdtemp()
+        self.vmail = os.path.join( self.dir, 'vmail' )
+        os.makedirs( os.path.join( self.vmail, 'example.com', 'bob' ) )
+        index_path = os.path.join( self.dir, 'filters.json' )
+        # One index per worker process
+        self.indexes = [ sieve.FilterIndex( self.vmail, '.dovecot.sieve', index_path=index_path )
+                for i in range( 2 ) ]
+
+    def tearDown( self ) :
+        shutil.rmtree( self.dir )
+
+    def exists( self, index, mailbox ) :
+        return index.get()[mailbox][1]
+
+    def test_filter_saved_by_another_process( self ) :
+        for index in self.indexes :
+            self.assertFalse( self.exists( index, 'bob@example.com' ) )
+
+        # Creating the file doesn't change the domain directory
+        with open( os.path.join( self.vmail, 'example.com', 'bob', '.dovecot.sieve' ), 'w' ) as f :
+            f.write( 'keep;\n' )
+        self.indexes[0].set_exists( 'bob@example.com' )
+
+        for index in self.indexes :
+            self.assertTrue( self.exists( index, 'bob@example.com' ) )
+
+        self.indexes[1].set_exists( 'bob@example.com', False )
+        self.assertFalse( self.exists( self.indexes[0], 'bob@example.com' ) )
+
+
+if __name__ == '__main__' :
+    unittest.main()
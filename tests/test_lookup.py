@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""Socketmap lookups served from a temporary database
+
+Run with : python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from sparrowmail import database, migrations, lookup
+
+
+class SocketmapTest( unittest.TestCase ) :
+
+    def setUp( self ) :
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join( self.dir, 'test.db' )
+        self.db = database.connect( self.path )
+        # Nothing to import the passwords from in an empty database
+        migrations.migrate( self.db, passwd_file_path=os.path.join( self.dir, 'passwd' ) )
+        self.db.execute( "INSERT INTO mails (address) VALUES ('bob@example.com')" )
+        self.db.execute( """INSERT INTO mails (address, target_id)
+                SELECT 'alias@example.com', id FROM mails WHERE address='bob@example.com'""" )
+        self.db.commit()
+
+        # Ephemeral port
+        self.server = lookup.SocketmapServer( ( '127.0.0.1', 0 ),
+                lookup.MailsLookup( self.path, 100, busy_timeout=1000 ) )
+        self.thread = threading.Thread( target=self.server.serve_forever )
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = lookup.SocketmapClient( *self.server.server_address )
+
+    def tearDown( self ) :
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.db.close()
+        shutil.rmtree( self.dir )
+
+    def test_hit( self ) :
+        self.assertEqual( self.client.lookup( 'mailboxes', u'bob@example.com' ), ( 'OK', u'bob@example.com' ) )
+        self.assertEqual( self.client.lookup( 'aliases', u'alias@example.com' ), ( 'OK', u'bob@example.com' ) )
+        # Answered from the cache the second time
+        self.assertEqual( self.client.lookup( 'aliases', u'alias@example.com' ), ( 'OK', u'bob@example.com' ) )
+        self.assertGreater( self.server.lookup.cache.hits, 0 )
+
+    def test_connection_settings( self ) :
+        db = self.server.lookup._connection()
+        self.assertEqual( db.execute( 'PRAGMA journal_mode' ).fetchone()[0], 'wal' )
+        self.assertEqual( db.execute( 'PRAGMA busy_timeout' ).fetchone()[0], 1000 )
+
+    def test_miss( self ) :
+        self.assertEqual( self.client.lookup( 'mailboxes', u'nobody@example.com' ), ( 'NOTFOUND', u'' ) )
+        # An alias isn't a mailbox
+        self.assertEqual( self.client.lookup( 'mailboxes', u'alias@example.com' ), ( 'NOTFOUND', u'' ) )
+        self.assertEqual( self.client.lookup( 'unknown', u'bob@example.com' )[0], 'PERM' )
+
+    def test_invalidation( self ) :
+        self.assertEqual( self.client.lookup( 'mailboxes', u'new@example.com' ), ( 'NOTFOUND', u'' ) )
+        self.assertEqual( self.client.lookup( 'aliases', u'alias@example.com' ), ( 'OK', u'bob@example.com' ) )
+
+        # Committed by another connection, the cached answers are dropped
+        self.db.execute( "INSERT INTO mails (address) VALUES ('new@example.com')" )
+        self.db.execute( """UPDATE mails SET target_id=( SELECT id FROM mails WHERE address='new@example.com' )
+                WHERE address='alias@example.com'""" )
+        self.db.commit()
+        self.assertEqual( self.client.lookup( 'mailboxes', u'new@example.com' ), ( 'OK', u'new@example.com' ) )
+        self.assertEqual( self.client.lookup( 'aliases', u'alias@example.com' ), ( 'OK', u'new@example.com' ) )
+
+        self.db.execute( "DELETE FROM mails WHERE address='new@example.com'" )
+        self.db.commit()
+        self.assertEqual( self.client.lookup( 'mailboxes', u'new@example.com' ), ( 'NOTFOUND', u'' ) )
+        self.assertEqual( self.client.lookup( 'aliases', u'alias@example.com' ), ( 'NOTFOUND', u'' ) )
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""Migration of a database made by the first SparrowMail versions
+
+Run with : python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sqlite3
+import calendar
+import tempfile
+import unittest
+
+from sparrowmail import database, migrations, search, changes
+
+# Tables as the first versions created them, end dates were python datetimes
+BASELINE = """
+CREATE TABLE users (
+    id integer primary key autoincrement,
+    username text not null unique,
+    password text not null,
+    salt text not null
+);
+INSERT INTO users (username, password, salt)
+VALUES ("user", "b2d1349ea3f52597f37566ed4095e10729c8329c612b64563849dcf29ee9de6e", "123456789");
+CREATE TABLE mails (
+    id           integer primary key autoincrement,
+    address      text    not null unique,
+    target_id    integer,
+    end_date     integer
+);
+INSERT INTO mails (id, address, target_id, end_date) VALUES (1, 'bob@example.com', NULL, NULL);
+INSERT INTO mails (id, address, target_id, end_date) VALUES (2, 'tmp@example.com', NULL, '2030-01-02 03:04:05.500000');
+INSERT INTO mails (id, address, target_id, end_date) VALUES (3, 'alias@example.com', 1, '2031-06-07 08:09:10');
+INSERT INTO mails (id, address, target_id, end_date) VALUES (4, 'orphan@example.com', 42, NULL);
+"""
+
+
+class MigrationsTest( unittest.TestCase ) :
+
+    def setUp( self ) :
+        self.dir = tempfile.mkdtemp()
+        self.passwd_path = os.path.join( self.dir, 'passwd' )
+        with open( self.passwd_path, 'w' ) as f :
+            f.write( 'bob@example.com:{SSHA512}bob\ntmp@example.com:{SSHA512}tmp\n' )
+
+        path = os.path.join( self.dir, 'test.db' )
+        old = sqlite3.connect( path )
+        old.executescript( BASELINE )
+        old.close()
+        self.db = database.connect( path )
+
+    def tearDown( self ) :
+        self.db.close()
+        shutil.rmtree( self.dir )
+
+    def migrate( self, target=None ) :
+        return migrations.migrate( self.db, target, passwd_file_path=self.passwd_path )
+
+    def triggers( self ) :
+        cur = self.db.execute( "SELECT name FROM sqlite_master WHERE type='trigger' AND tbl_name='mails'" )
+        return set( row[0] for row in cur )
+
+    def address( self, address ) :
+        return self.db.execute( 'SELECT * FROM mails WHERE address=?', [ address ] ).fetchone()
+
+    def test_baseline_to_latest( self ) :
+        self.assertEqual( self.migrate(), [ version for version, d, f in migrations.MIGRATIONS ] )
+        self.assertEqual( migrations.get_version( self.db ), migrations.LATEST_VERSION )
+        # Nothing left to apply
+        self.assertEqual( self.migrate(), [] )
+
+        # Epoch end dates in UTC, the fraction of second dropped
+        self.assertEqual( self.address( 'tmp@example.com' )['end_date'],
+                calendar.timegm( ( 2030, 1, 2, 3, 4, 5 ) ) )
+        self.assertEqual( self.address( 'alias@example.com' )['end_date'],
+                calendar.timegm( ( 2031, 6, 7, 8, 9, 10 ) ) )
+        self.assertIsNone( self.address( 'bob@example.com' )['end_date'] )
+
+        # Passwords imported from the passwd file
+        self.assertEqual( self.address( 'bob@example.com' )['password'], '{SSHA512}bob' )
+
+        # The alias of a missing mailbox is gone, the others go with their mailbox
+        self.assertIsNone( self.address( 'orphan@example.com' ) )
+        with self.db :
+            self.db.execute( "DELETE FROM mails WHERE address='bob@example.com'" )
+        self.assertIsNone( self.address( 'alias@example.com' ) )
+        self.assertRaises( sqlite3.IntegrityError, self.db.execute,
+                "INSERT INTO mails (address, target_id) VALUES ('x@example.com', 42)" )
+
+        # Both changes are in the journal
+        rows, complete = changes.since( self.db, 0 )
+        self.assertEqual( sorted( ( row['op'], row['address'] ) for row in rows ),
+                [ ( 'delete', 'alias@example.com' ), ( 'delete', 'bob@example.com' ) ] )
+
+    def test_triggers_recreated( self ) :
+        # The search index of a database migrated before the mails table was rebuilt
+        self.migrate( 2 )
+        if not search.create_index( self.db ) :
+            self.skipTest( 'This SQLite has no FTS5 trigram support' )
+        self.migrate()
+        self.assertEqual( self.triggers(), set( [ 'mails_search_insert', 'mails_search_delete',
+                'mails_search_update', 'mails_changes_insert', 'mails_changes_delete',
+                'mails_changes_update' ] ) )
+
+        with self.db :
+            self.db.execute( "INSERT INTO mails (address) VALUES ('new@example.com')" )
+        self.assertEqual( [ row['address'] for row in search.search_mails( self.db, 'new@exa' ) ],
+                [ 'new@example.com' ] )
+
+        # Rebuilding the mails table again keeps the triggers of both
+        before = self.triggers()
+        self.db.isolation_level = None
+        self.db.execute( 'PRAGMA foreign_keys=OFF' )
+        self.db.execute( 'BEGIN' )
+        migrations._mails_foreign_key( self.db, {} )
+        self.db.execute( 'COMMIT' )
+        self.assertEqual( self.triggers(), before )
+
+        seq = changes.latest( self.db )
+        self.db.execute( "UPDATE mails SET end_date=1 WHERE address='new@example.com'" )
+        self.assertEqual( changes.latest( self.db ), seq + 1 )
+        self.assertEqual( [ row['address'] for row in search.search_mails( self.db, 'new@exa' ) ],
+                [ 'new@example.com' ] )
+
+    def test_reset( self ) :
+        self.migrate()
+        migrations.reset( self.db )
+        self.assertEqual( migrations.get_version( self.db ), 0 )
+        self.assertEqual( self.db.execute( "SELECT name FROM sqlite_master WHERE type='table'"
+                " AND name NOT LIKE 'sqlite_%'" ).fetchall(), [] )
+
+        # A new database is made from scratch
+        self.migrate()
+        self.assertEqual( self.db.execute( 'SELECT COUNT(*) FROM mails' ).fetchone()[0], 0 )
+        self.assertEqual( self.db.execute( 'SELECT COUNT(*) FROM users' ).fetchone()[0], 1 )
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""Replication of a journal to two nodes made of local directories
+
+Run with : python -m unittest discover tests
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from sparrowmail import replication
+
+
+class ReplicationTest( unittest.TestCase ) :
+
+    def setUp( self ) :
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join( self.dir, 'src' )
+        os.makedirs( os.path.join( self.src, 'vmail', 'example.com', 'bob' ) )
+        os.makedirs( os.path.join( self.src, 'postfix' ) )
+        os.makedirs( os.path.join( self.src, 'dovecot' ) )
+        self.journal = replication.Journal( os.path.join( self.dir, 'journal' ), history=3 )
+        source = replication.JournalSource( self.journal )
+
+        # One node with all the files in one directory, one with a directory per kind
+        self.node1 = os.path.join( self.dir, 'node1' )
+        self.node2 = dict( ( kind, os.path.join( self.dir, 'node2', kind ) )
+                for kind in ( 'postfix', 'dovecot', 'vmail' ) )
+        self.agents = [
+            replication.Agent( source, self.node1, os.path.join( self.dir, 'node1.json' ), 'node1' ),
+            replication.Agent( source, self.node2, os.path.join( self.dir, 'node2.json' ), 'node2' ),
+        ]
+
+    def tearDown( self ) :
+        shutil.rmtree( self.dir )
+
+    def publish( self, name, data ) :
+        """Write a file of the main node and record it in the journal"""
+
+        path = os.path.join( self.src, *name.split( '/' ) )
+        if data is None :
+            os.remove( path )
+        else :
+            with open( path, 'wb' ) as f :
+                f.write( data )
+        return self.journal.record( { name : path } )
+
+    def read( self, agent, name ) :
+        path = agent.target_path( name )
+        if not os.path.exists( path ) :
+            return None
+        with open( path, 'rb' ) as f :
+            return f.read()
+
+    def run_agents( self, version ) :
+        for agent in self.agents :
+            self.assertEqual( agent.run_once(), (True, version) )
+
+    def test_replicate( self ) :
+        self.publish( 'postfix/aliases', b'a@example.com b@example.com\n' )
+        self.publish( 'dovecot/passwd', b'b@example.com:{SSHA512}x\n' )
+        version = self.publish( 'vmail/example.com/bob/.dovecot.sieve', b'keep;\n' )
+        self.run_agents( version )
+
+        self.assertEqual( self.read( self.agents[0], 'postfix/aliases' ), b'a@example.com b@example.com\n' )
+        self.assertEqual( self.read( self.agents[1], 'dovecot/passwd' ), b'b@example.com:{SSHA512}x\n' )
+        self.assertTrue( os.path.exists( os.path.join( self.node2['vmail'], 'example.com', 'bob', '.dovecot.sieve' ) ) )
+
+        # Only the delta is pulled, removals included
+        version = self.publish( 'postfix/aliases', b'c@example.com b@example.com\n' )
+        version = self.publish( 'dovecot/passwd', None )
+        delta = self.journal.delta( version - 2 )
+        self.assertFalse( delta['full'] )
+        self.assertEqual( sorted( delta['files'] ), [ 'postfix/aliases' ] )
+        self.assertEqual( delta['removed'], [ 'dovecot/passwd' ] )
+        self.run_agents( version )
+        for agent in self.agents :
+            self.assertEqual( self.read( agent, 'postfix/aliases' ), b'c@example.com b@example.com\n' )
+            self.assertIsNone( self.read( agent, 'dovecot/passwd' ) )
+
+        nodes = dict( ( n['node'], n ) for n in self.journal.status()['nodes'] )
+        self.assertEqual( nodes['node1']['version'], version )
+        self.assertEqual( nodes['node2']['version'], version )
+        self.assertIsNone( nodes['node2']['error'] )
+
+    def test_repair_modified_file( self ) :
+        version = self.publish( 'postfix/aliases', b'a@example.com b@example.com\n' )
+        self.run_agents( version )
+
+        # Same size and mtime, only the checksum tells
+        path = self.agents[0].target_path( 'postfix/aliases' )
+        st = os.stat( path )
+        with open( path, 'wb' ) as f :
+            f.write( b'x@example.com b@example.com\n' )
+        os.utime( path, ( st.st_atime, st.st_mtime ) )
+        os.remove( self.agents[1].target_path( 'postfix/aliases' ) )
+
+        # A new version whose delta doesn't contain the modified file
+        version = self.publish( 'dovecot/passwd', b'b@example.com:{SSHA512}x\n' )
+        self.run_agents( version )
+        for agent in self.agents :
+            self.assertEqual( self.read( agent, 'postfix/aliases' ), b'a@example.com b@example.com\n' )
+
+        # Without any new version
+        with open( path, 'wb' ) as f :
+            f.write( b'tampered\n' )
+        self.run_agents( version )
+        self.assertEqual( self.read( self.agents[0], 'postfix/aliases' ), b'a@example.com b@example.com\n' )
+
+    def test_corrupted_blob( self ) :
+        version = self.publish( 'postfix/aliases', b'a@example.com b@example.com\n' )
+        self.run_agents( version )
+
+        version = self.publish( 'postfix/aliases', b'c@example.com b@example.com\n' )
+        sha = self.journal.manifest( version )['files']['postfix/aliases']['sha256']
+        blob_path = os.path.join( self.journal.directory, 'blobs', sha )
+        with open( blob_path, 'wb' ) as f :
+            f.write( b'evil\n' )
+
+        # Nothing is applied, the node keeps its version and reports the error
+        result = self.agents[0].run_once()
+        self.assertFalse( result[0] )
+        self.assertEqual( self.read( self.agents[0], 'postfix/aliases' ), b'a@example.com b@example.com\n' )
+        self.assertEqual( self.agents[0].state()['version'], version - 1 )
+        with open( os.path.join( self.journal.directory, 'nodes', 'node1.json' ) ) as f :
+            self.assertIsNotNone( json.load( f )['error'] )
+
+        with open( blob_path, 'wb' ) as f :
+            f.write( b'c@example.com b@example.com\n' )
+        self.run_agents( version )
+        self.assertEqual( self.read( self.agents[0], 'postfix/aliases' ), b'c@example.com b@example.com\n' )
+
+    def test_old_replica_gets_everything( self ) :
+        version = self.publish( 'postfix/aliases', b'a@example.com b@example.com\n' )
+        self.agents[0].run_once()
+        for i in range( 5 ) :
+            version = self.publish( 'postfix/mailboxes', ( 'm%d@example.com\n' % i ).encode( 'utf-8' ) )
+
+        # The versions after the one it applied were pruned
+        self.assertTrue( self.journal.delta( 1 )['full'] )
+        self.run_agents( version )
+        self.assertEqual( self.read( self.agents[0], 'postfix/mailboxes' ), b'm4@example.com\n' )
+
+    def test_invalid_names( self ) :
+        for name in ( '../etc/passwd', '/etc/passwd', 'postfix/../../x', 'aliases' ) :
+            self.assertRaises( replication.ReplicationError, replication.check_name, name )
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming import of the mails into a temporary database
+
+Run with : python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from sparrowmail import database, migrations, transfer
+
+
+class ImportTest( unittest.TestCase ) :
+
+    def setUp( self ) :
+        self.dir = tempfile.mkdtemp()
+        self.db = database.connect( os.path.join( self.dir, 'test.db' ) )
+        migrations.migrate( self.db, passwd_file_path=os.path.join( self.dir, 'passwd' ) )
+
+    def tearDown( self ) :
+        self.db.close()
+        shutil.rmtree( self.dir )
+
+    def test_malformed_non_ascii_row( self ) :
+        data = StringIO( u"""address,mailbox,end_date,password
+bob@example.com,,,{SSHA512}x
+a@éé☃.com,,,
+alias@example.com,bob@example.com,2030-01-01 00:00:00,
+""".encode( 'utf-8' ) )
+        reports = []
+        imported, skipped = transfer.import_rows( self.db, transfer.read_rows( data, 'csv' ), 2,
+                lambda number, reason : reports.append( ( number, reason ) ) )
+
+        # The bad row is reported and the ones after it are still imported
+        self.assertEqual( ( imported, skipped ), ( 2, 1 ) )
+        self.assertEqual( len( reports ), 1 )
+        self.assertEqual( reports[0][0], 2 )
+        self.assertIsInstance( reports[0][1], unicode )
+        addresses = [ row[0] for row in self.db.execute( 'SELECT address FROM mails ORDER BY address' ) ]
+        self.assertEqual( addresses, [ u'alias@example.com', u'bob@example.com' ] )
+
+
+if __name__ == '__main__' :
+    unittest.main()